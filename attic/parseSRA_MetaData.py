@@ -2,10 +2,13 @@
 
 
 import os
+import re
 
 import h5py
 import pandas as pd
 import glob
+
+from scqc.impute import TechMatcher, get_lcp_cache
 # from numpy.lib.npyio import save
 
 # load the full df. 
@@ -49,11 +52,14 @@ def predictTechFromLCP(df) :
 
     uLCP = pd.DataFrame({"LCP" : df.LCP.unique() })
     
-    # search for the keywords
-    for i in range(len(keywords)) :
-        key= list(keywords)[i]
-        kw = keywords[key] 
-        uLCP[key] = uLCP.LCP.str.lower().str.contains(kw.lower())
+    # search for the keywords. same matcher and persistent lcp cache as scqc.impute, 
+    # keyed on this keyword set so edits here invalidate it.
+    matcher = TechMatcher({ key : re.compile(kw, re.IGNORECASE) for key, kw in keywords.items() })
+    cache = get_lcp_cache(metaDirec + "/lcp-techs-attic.txt", matcher)
+    lcps = [ lcp if isinstance(lcp, str) else "" for lcp in uLCP.LCP ]
+    hits = cache.lookup(lcps)
+    for key in keywords :
+        uLCP[key] = [ key in techs for techs in hits ]
 
     # only keep the ones where a keyword was found
     # ["Experiment","Submission","Runs","Project"]
@@ -12,13 +12,15 @@ from threading import Thread
 
 import numpy as np
 import pandas as pd
-import scanpy as sc  # pip install
-from scipy.io import mmread
 
 
 gitpath = os.path.expanduser("~/git/scqc")
 sys.path.append(gitpath)
 from scqc.utils import *
+from scqc.soloout import SoloOut
+
+# pip install. several seconds to import, only needed once stats are computed.
+sc = lazy_import('scanpy')
 
 LOGLEVELS = {
     10: 'debug',
@@ -54,24 +56,20 @@ class GetStats(object):
         self.starindexdir = os.path.expanduser(
             self.config.get('stats', 'starindexdir'))
         self.metadir = os.path.expanduser(self.config.get('stats', 'metadir'))
+        self.solo = None
 
-    def _gather_stats_from_STAR(self):
-
-        with open(f"{self.solooutdir}/Barcodes.stats", 'r') as f:
-            lines = f.readlines()
-            lines = [" ".join(line.split()) for line in lines]
-            lines = [line.split() for line in lines]
-            barcode_stats = pd.DataFrame(lines, columns=["stat", "value"])
+    def _soloout(self):
+        # parsed once, shared by the stats and the matrix. 
+        if self.solo is None:
+            self.solo = SoloOut(self.solooutdir, self.starindexdir)
+        return self.solo
 
-        with open(f"{self.solooutdir}/Gene/Features.stats", 'r') as f:
-            lines = f.readlines()
-            lines = [" ".join(line.split()) for line in lines]
-            lines = [line.split() for line in lines]
-            feature_stats = pd.DataFrame(lines, columns=["stat", "value"])
+    def _gather_stats_from_STAR(self):
 
-        summary_stats = pd.read_csv(
-            f"{self.solooutdir}/Gene/Summary.csv", sep=",", header=None)
-        summary_stats.columns = ["stat", "value"]
+        solo = self._soloout()
+        barcode_stats = solo.barcode_stats.copy()
+        feature_stats = solo.feature_stats.copy()
+        summary_stats = solo.summary.copy()
 
         acc = self.solooutdir.split("/")[-1].split("Solo.out")[0][:-1]
         barcode_stats['stat_source'] = 'barcode'
@@ -87,33 +85,18 @@ class GetStats(object):
 
     def _parse_STAR_mtx(self):
         # note that scanpy uses cell x gene.
-        # read into anndata
         # path should end with "Solo.out"
         # solooutdir = "/home/johlee/scqc/starout/SRP308826_smartseq_Solo.out"
-        path = f'{self.solooutdir}/Gene/filtered'
-
-        # mtx_files = os.listdir(path)
-        adata = sc.read(f'{path}/matrix.mtx').T
-
-        geneinfo = pd.read_csv(
-            '~/scqc/supplement_data/genomes/mouse/STAR_index/geneInfo.tab', sep="\t",  skiprows=1, header=None, dtype=str)
-        geneinfo.columns = ['gene_accession', 'gene_symbol', 'type']
-        # geneinfo.index = geneinfo.gene_accession
-
-        genenames = pd.read_csv(f'{path}/features.tsv',
-                                sep="\t", header=None, dtype=str)
-        genenames.columns = ['gene_accession', 'gene_symbol', 'source']
+        solo = self._soloout()
+        filtered = solo.filtered
 
-        genenames = genenames.merge(geneinfo, how='left', on=[
+        genenames = filtered.features.merge(solo.geneinfo, how='left', on=[
             "gene_accession", 'gene_symbol'], indicator=True)
         genenames.index = genenames.gene_accession
 
-        cellids = pd.read_csv(f'{path}/barcodes.tsv', sep="\t", header=None)
-        cellids.columns = ["cell_id"]
-        # cellids.index = cellids.cell_id
+        cellids = pd.DataFrame({"cell_id": filtered.barcodes})
 
-        adata.var = genenames
-        adata.obs = cellids
+        adata = sc.AnnData(X=filtered.X, obs=cellids, var=genenames)
 
         return adata
 
@@ -164,12 +147,12 @@ class GetStats(object):
             percent_top=(50, 100, 200, 500), inplace=True, use_raw=False,
             qc_vars=qcvars)
 
-        # computes the N+M x N+M corrcoef matrix - extract off diagonal block
-        adata.obs['corr_to_mean'] = np.array(sparse_pairwise_corr(
-            adata.var.mean_counts, adata.X)[0, 1:]).flatten()
+        # each cell against the mean, without the (cells+1)^2 corrcoef matrix
+        adata.obs['corr_to_mean'] = sparse_corr_to_vector(
+            adata.X, adata.var.mean_counts.values)
 
-        # this part is slow (~10-15 min) because of a for loop - can parallelize
-        adata.obs['gini'] = gini_coefficient_spmat(adata.X )
+        # sorted closed form, O(nnz log nnz)
+        adata.obs['gini'] = gini_coefficient_spmat(adata.X)
 
         # unstructured data - dataset specific
         adata.uns['gini_by_counts'] = gini_coefficient(
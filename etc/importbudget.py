@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# checks import time of each entry point against its budget.
+# each module is imported in a fresh interpreter with -X importtime.
+# heavy dependencies (pandas, numpy, scipy, scanpy) should be lazy (utils.lazy_import),
+# so they don't count here.
+#
+#   python etc/importbudget.py          from the repo root. exits 1 if over budget.
+#
+
+import os
+import subprocess
+import sys
+
+# module -> seconds
+BUDGETS = {
+    'scqc.utils': 0.1,
+    'scqc.eutils': 0.3,
+    'scqc.sra': 0.3,
+    'scqc.impute': 0.3,
+    'scqc.star': 0.3,
+    'scqc.core': 0.3,
+}
+
+HEAVY = ['pandas', 'numpy', 'scipy', 'scanpy']
+
+
+def import_time(module, repeat=3):
+    '''
+    Best of repeat cumulative import times (seconds), and heavy modules it imported.
+    '''
+    rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    heavy = []
+    for i in range(repeat):
+        cp = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=rootdir, capture_output=True, text=True)
+        if cp.returncode != 0:
+            raise ImportError(cp.stderr)
+        lines = [line.split('|') for line in cp.stderr.splitlines() if line.startswith('import time:')]
+        us = [int(f[1]) for f in lines if f[2].strip() == module][0]
+        best = us if best is None else min(best, us)
+        heavy = [f[2].strip() for f in lines if f[2].strip() in HEAVY]
+    return (best / 1e6, heavy)
+
+
+if __name__ == '__main__':
+    over = False
+    for (module, budget) in BUDGETS.items():
+        (took, heavy) = import_time(module)
+        status = 'ok'
+        if took > budget or len(heavy) > 0:
+            status = 'OVER'
+            over = True
+        print(f'{module:<14} {took:6.3f}s  budget {budget:.1f}s  {status}  {" ".join(heavy)}')
+    sys.exit(1 if over else 0)
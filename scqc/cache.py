@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+#  Disk budget for cachedir, shared by all stages.
+#
+#  Every artifact a stage leaves in cachedir (.sra from download, fastq from dumps) is
+#  registered with its size, producing stage, consuming stage and last access time in
+#  <metadir>/cache.db. Once the consumer is done with a run, its artifacts become
+#  evictable, least recently used first. Files in cachedir nobody registered still count
+#  against the budget but are never evicted.
+#
+#  Download calls reserve() before fetching. It evicts what it can and waits until the
+#  download fits under cache_budget_gb, so downloads can't run ahead of alignment and
+#  fill the disk. It only waits while some other project's files may still be consumed
+#  (and at most cache_wait seconds). Otherwise the download is deferred to a later cycle.
+#
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+GB = 1024 * 1024 * 1024
+
+# partial downloads. not counted in usage, their size is already reserved.
+TRANSIENT_SUFFIXES = ('.part', '.journal')
+
+
+class CacheManager(object):
+    '''
+    Tracks artifacts under cachedir and enforces the byte budget.
+
+    Config [<section>] options (usually from DEFAULT):
+        cache_budget_gb     byte budget for cachedir. 0 for unlimited.
+        cache_wait          max seconds reserve() waits for space.
+        pollinterval        seconds between checks while reserve() waits.
+    '''
+
+    def __init__(self, config, section='download'):
+        self.log = logging.getLogger('cache')
+        self.cachedir = os.path.expanduser(config.get(section, 'cachedir'))
+        self.metadir = os.path.expanduser(config.get(section, 'metadir'))
+        self.dbfile = f'{self.metadir}/cache.db'
+        self.budget = int(float(config.get(section, 'cache_budget_gb')) * GB)
+        self.pollinterval = float(config.get(section, 'pollinterval'))
+        self.wait = float(config.get(section, 'cache_wait'))
+        # bytes promised to in-process downloads that haven't hit the disk yet.
+        self.reserved = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.metadir, exist_ok=True)
+        with self._connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+                            path TEXT PRIMARY KEY, size INTEGER, producer TEXT, consumer TEXT,
+                            run_id TEXT, proj_id TEXT, last_access REAL, consumed INTEGER)''')
+            con.execute('CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts(run_id)')
+            con.execute('CREATE INDEX IF NOT EXISTS artifacts_lru ON artifacts(consumed, last_access)')
+
+    def _connect(self):
+        # long timeout: several stage daemons may write at once.
+        return sqlite3.connect(self.dbfile, timeout=600)
+
+    def register(self, path, producer, consumer, run_id=None, proj_id=None):
+        '''
+        Record a finished artifact. Re-registering a path resets it to unconsumed.
+        '''
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.log.warning(f'not registering missing artifact {path}')
+            return
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO artifacts VALUES (?,?,?,?,?,?,?,0)',
+                        (os.path.abspath(path), size, producer, consumer, run_id, proj_id, time.time()))
+        self.log.debug(f'registered {path} {size} bytes {producer} -> {consumer}')
+
+    def touch(self, path):
+        with self._connect() as con:
+            con.execute('UPDATE artifacts SET last_access=? WHERE path=?',
+                        (time.time(), os.path.abspath(path)))
+
+    def consumed(self, run_id, consumer):
+        '''
+        consumer is done with run_id's artifacts. They may now be evicted.
+        '''
+        with self._connect() as con:
+            n = con.execute('UPDATE artifacts SET consumed=1, last_access=? WHERE run_id=? AND consumer=?',
+                            (time.time(), run_id, consumer)).rowcount
+        self.log.debug(f'{n} artifacts of {run_id} released by {consumer}')
+
+    def usage(self):
+        '''
+        Bytes currently in cachedir, registered or not. 
+        Partial downloads are left out, they are covered by their reservation.
+        '''
+        total = 0
+        for (root, dirs, files) in os.walk(self.cachedir):
+            for name in files:
+                if name.endswith(TRANSIENT_SUFFIXES):
+                    continue
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                total += st.st_size
+        return total
+
+    def evict(self, needed=0):
+        '''
+        Delete consumed artifacts, least recently used first, until usage + reserved
+        + needed fits the budget (or nothing evictable is left). Returns bytes freed.
+        '''
+        if self.budget <= 0:
+            return 0
+        over = self.usage() + self.reserved + needed - self.budget
+        freed = 0
+        if over <= 0:
+            return 0
+        with self._connect() as con:
+            rows = con.execute('SELECT path, size FROM artifacts WHERE consumed=1 ORDER BY last_access').fetchall()
+            for (path, size) in rows:
+                if freed >= over:
+                    break
+                try:
+                    os.remove(path)
+                    freed += size
+                    self.log.info(f'evicted {path} ({size} bytes)')
+                except FileNotFoundError:
+                    pass
+                except OSError as ex:
+                    self.log.warning(f'unable to evict {path}: {ex}')
+                    continue
+                con.execute('DELETE FROM artifacts WHERE path=?', (path,))
+                self._remove_empty_dir(os.path.dirname(path))
+        return freed
+
+    def _remove_empty_dir(self, dirpath):
+        # prefetch puts runs in cachedir/<run>/
+        if os.path.abspath(dirpath) != os.path.abspath(self.cachedir):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+    def pending(self, exclude=()):
+        '''
+        Bytes of unconsumed artifacts, except those of projects in exclude.
+        What eviction could still free once their consumers are done.
+        '''
+        with self._connect() as con:
+            rows = con.execute('SELECT proj_id, SUM(size) FROM artifacts WHERE consumed=0 '
+                               'GROUP BY proj_id').fetchall()
+        return sum(n for (p, n) in rows if p not in exclude and n is not None)
+
+    def reserve(self, nbytes, exclude=(), force=False, timeout=None):
+        '''
+        Wait until nbytes fits under the budget, evicting what can be evicted.
+        True once reserved. Call unreserve(nbytes) when the download is done or failed.
+
+        False (nothing reserved, caller should defer) after timeout (default cache_wait)
+        seconds, or at once if the space could only come from unconsumed artifacts of
+        projects in exclude.
+        Those are the caller's own batch, which can't be consumed before it returns.
+        A request larger than the whole budget, or with force, is let through with a warning.
+        '''
+        nbytes = int(nbytes)
+        if self.budget <= 0:
+            return True
+        if nbytes > self.budget or force:
+            if not force:
+                self.log.warning(f'{nbytes} bytes exceeds cache budget {self.budget}. not waiting.')
+            with self.lock:
+                self.reserved += nbytes
+            return True
+        if timeout is None:
+            timeout = self.wait
+        waited = 0
+        while True:
+            with self.lock:
+                self.evict(nbytes)
+                over = self.usage() + self.reserved + nbytes - self.budget
+                if over <= 0:
+                    self.reserved += nbytes
+                    if waited > 0:
+                        self.log.info(f'reserved {nbytes} bytes after {waited:.0f}s')
+                    return True
+            if over > self.pending(exclude):
+                self.log.info(f'cache budget full and nothing that will be freed in time. '
+                              f'not reserving {nbytes} bytes.')
+                return False
+            if waited >= timeout:
+                self.log.info(f'gave up reserving {nbytes} bytes after {waited:.0f}s')
+                return False
+            if waited == 0:
+                self.log.info(f'cache budget full, waiting to reserve {nbytes} bytes')
+            time.sleep(self.pollinterval)
+            waited += self.pollinterval
+
+    def unreserve(self, nbytes):
+        if self.budget <= 0:
+            return
+        with self.lock:
+            self.reserved = max(0, self.reserved - int(nbytes))
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_cache(config, section='download'):
+    '''
+    Process-wide CacheManager for the section's cachedir, so all download threads
+    share one reservation count.
+    '''
+    cachedir = os.path.expanduser(config.get(section, 'cachedir'))
+    with _managers_lock:
+        if cachedir not in _managers:
+            _managers[cachedir] = CacheManager(config, section)
+        return _managers[cachedir]
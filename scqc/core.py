@@ -6,17 +6,27 @@ import argparse
 import fcntl
 import io
 import logging
+import multiprocessing
 import os
 import tempfile
+import threading
 import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from configparser import ConfigParser
-from queue import Queue
+from queue import Queue, Empty
 
-from scqc import sra, star
+from scqc import sra, star, impute
+from scqc.cache import GB, get_cache
+from scqc.download import DownloadScheduler
 from scqc.utils import *
 
+try:
+    import inotify_simple   # optional, for wakeup = inotify
+except ImportError:
+    inotify_simple = None
+
 
 def get_default_config():
     cp = ConfigParser()
@@ -24,6 +34,77 @@ def get_default_config():
     return cp
 
 
+class TodoWatcher(object):
+    '''
+    Waits until a stage's todofile changes, or timeout seconds pass, whichever is first. 
+    modes:
+        sleep    plain sleep for timeout (original behavior). 
+        poll     stat() todofile every pollinterval seconds. Works on NFS. 
+        inotify  kernel notification on the todofile's directory (needs inotify_simple). 
+                 Only sees writes made from this host; falls back to poll if unavailable. 
+    '''
+
+    def __init__(self, todofile, mode='sleep', pollinterval=10.0):
+        self.log = logging.getLogger('core')
+        self.todofile = todofile
+        self.mode = mode
+        self.pollinterval = pollinterval
+        self.inotify = None
+        if self.todofile is None:
+            self.mode = 'sleep'
+        if self.mode == 'inotify':
+            if inotify_simple is None:
+                self.log.warning('inotify_simple not installed. using poll wakeup.')
+                self.mode = 'poll'
+            else:
+                flags = inotify_simple.flags
+                self.inotify = inotify_simple.INotify()
+                # watch directory: writelist renames a new file over the todofile.
+                self.inotify.add_watch(os.path.dirname(self.todofile) or '.',
+                                       flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY)
+        self.mark()
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.todofile)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except (OSError, TypeError):
+            return None
+
+    def mark(self):
+        '''
+        Remember todofile state. Changes after this wake the next wait(). 
+        '''
+        self.stamp = self._stamp()
+
+    def wait(self, timeout):
+        '''
+        Returns True if woken by a todofile change, False on timeout. 
+        '''
+        if self.mode == 'sleep':
+            time.sleep(timeout)
+            return False
+
+        deadline = time.time() + timeout
+        if self.mode == 'inotify':
+            name = os.path.basename(self.todofile)
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                events = self.inotify.read(timeout=int(remaining * 1000))
+                if any([e.name == name for e in events]) and self._stamp() != self.stamp:
+                    return True
+
+        while True:
+            if self._stamp() != self.stamp:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.pollinterval, remaining))
+
+
 class Stage(object):
     '''
     Handles stage in pipeline. 
@@ -55,20 +136,27 @@ class Stage(object):
         self.batchsleep = float(self.config.get(f'{self.name}', 'batchsleep'))
         self.ncycles = int(self.config.get(f'{self.name}', 'ncycles'))
         self.outlist = []
+        # kept across cycles, only re-read what was appended. 
+        self.todo = TrackedList(self.todofile)
+        self.done = TrackedList(self.donefile)
+        # how to wait between cycles. sleep stays the upper bound in every mode.
+        self.wakeup = self.config.get(f'{self.name}', 'wakeup').lower().strip()
+        self.pollinterval = float(self.config.get(f'{self.name}', 'pollinterval'))
 
     def run(self):
         self.log.info(f'{self.name} run...')
         cycles = 0
         try:
+            watcher = TodoWatcher(self.todofile, self.wakeup, self.pollinterval)
             while not self.shutdown:
                 self.log.debug(
                     f'{self.name} cycle will be {self.sleep} seconds...')
-                self.todolist = readlist(self.todofile)
-                self.donelist = readlist(self.donefile)
-                if self.todolist is not None:
-                    self.dolist = listdiff(self.todolist, self.donelist)
-                else:
-                    self.dolist = []
+                # changes from here on wake the next wait, even if made while we work.
+                watcher.mark()
+                self.todo.refresh()
+                self.done.refresh()
+                self.dolist = [i for i in self.todo.items if i not in self.done.itemset]
+                self.dolist.sort()
                 # cut into batches and do each separately, updating donelist. 
                 logging.debug(f'dolist len={len(self.dolist)}')
                 curid = 0
@@ -84,11 +172,8 @@ class Stage(object):
                     self.log.debug(f"got finished list len={len(finished)}. writing...")
                     
                     if self.donefile is not None and len(finished) > 0:
-                        logging.info('reading current done.')
-                        donelist = readlist(self.donefile)
                         logging.info('adding just finished.')
-                        alldone = listmerge(finished, donelist)
-                        writelist(self.donefile, alldone)
+                        self.done.append(finished)
                         self.log.debug(
                             f"done writing donelist: {self.donefile}. sleeping {self.batchsleep} ...")
                     else:
@@ -96,15 +181,19 @@ class Stage(object):
                             'donefile is None or no new processing. No output.')
                         
                     curid += self.batchsize
-                    time.sleep(self.batchsleep)
+                    if curid < len(self.dolist):
+                        time.sleep(self.batchsleep)
+                # occasional sorted rewrite, not every batch.
+                self.done.compact()
                 cycles += 1
                 if cycles >= self.ncycles:
                     self.shutdown = True
 
                 # overall stage sleep
                 if not self.shutdown:
-                    logging.info(f'done with all batches. Sleeping for stage. {self.sleep} sec...')
-                    time.sleep(self.sleep)
+                    logging.info(f'done with all batches. Sleeping for stage. {self.sleep} sec ({self.wakeup})...')
+                    if watcher.wait(self.sleep):
+                        logging.info(f'{self.todofile} changed. waking up.')
 
         except KeyboardInterrupt:
             print('\nCtrl-C. stopping.')
@@ -130,23 +219,31 @@ class Query(Stage):
     def __init__(self, config):
         super(Query, self).__init__(config, 'query')
         self.log.debug('super() ran. object initialized.')
+        self.max_workers = int(self.config.get('query', 'max_workers'))
 
     def execute(self, dolist):
         '''
         Perform one run for stage.  
+        Queries run concurrently in threads (I/O bound, rate limited by the shared client). 
+        Results are written here, in this thread only, so metadata files aren't raced. 
         '''
         self.log.debug(f'got dolist len={len(dolist)}. executing...')
         outlist = []
-        for projectid in dolist:
-            self.log.debug(f'handling id {projectid}...')
-            try:
-                sq = sra.Query(self.config)
-                out = sq.execute(projectid)
-                self.log.debug(f'done with {projectid}')
-                outlist.append(out)
-            except Exception as ex:
-                self.log.warning(f"exception raised during project query: {projectid}")
-                self.log.error(traceback.format_exc(None))
+        sq = sra.Query(self.config)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {}
+            for projectid in dolist:
+                self.log.debug(f'handling id {projectid}...')
+                futures[pool.submit(sq.query, projectid)] = projectid
+            for f in as_completed(futures):
+                projectid = futures[f]
+                try:
+                    sq.write(f.result())
+                    self.log.debug(f'done with {projectid}')
+                    outlist.append(projectid)
+                except Exception as ex:
+                    self.log.warning(f"exception raised during project query: {projectid}")
+                    self.log.error(traceback.format_exc(None))
         self.log.debug(f"returning outlist len={len(outlist)}")
         return outlist
 
@@ -165,25 +262,34 @@ class Impute(Stage):
     def __init__(self, config):
         super(Impute, self).__init__(config, 'impute')
         self.log.debug('super() ran. object initialized.')
+        self.max_workers = int(self.config.get('impute', 'max_workers'))
 
     def execute(self, dolist):
         '''
         Perform one run for stage.  
+        Projects are imputed in a process pool, impute.tsv is written here only. 
+        Workers come from a forkserver, not fork(), since other stages' threads may be 
+        running (e.g. in Pipeline) and a forked child can inherit their held locks. 
         '''
         self.log.debug(f'got dolist len={len(dolist)}. executing...')
         outlist = []
-        for projectid in dolist:
-            self.log.debug(f'handling id {projectid}...')
-            try:
-                si = sra.Impute(self.config)
-                out = si.execute(projectid)
-                self.log.debug(f'done with {projectid}')
-                if out is not None:
-                    outlist.append(out)
+        si = impute.Impute(self.config)
+        with ProcessPoolExecutor(max_workers=self.max_workers,
+                                 mp_context=multiprocessing.get_context('forkserver')) as pool:
+            futures = {}
+            for projectid in dolist:
+                self.log.debug(f'handling id {projectid}...')
+                futures[pool.submit(impute_project, self.config, projectid)] = projectid
+            for f in as_completed(futures):
+                projectid = futures[f]
+                try:
+                    si.write(f.result(), projectid)
+                    self.log.debug(f'done with {projectid}')
+                    outlist.append(projectid)
             
-            except Exception as ex:
-                self.log.warning(f"exception raised during project query: {projectid}")
-                self.log.error(traceback.format_exc(None))
+                except Exception as ex:
+                    self.log.warning(f"exception raised during project impute: {projectid}")
+                    self.log.error(traceback.format_exc(None))
         self.log.debug(f"returning outlist len={len(outlist)}")
         return outlist
 
@@ -191,6 +297,14 @@ class Impute(Stage):
         sra.setup(self.config)
 
 
+def impute_project(config, projectid):
+    '''
+    Impute stage process pool worker. Module level so it can be pickled. 
+    '''
+    si = impute.Impute(config)
+    return si.impute(projectid)
+
+
 class Download(Stage):
 
     def __init__(self, config):
@@ -198,31 +312,66 @@ class Download(Stage):
         self.log.debug('super() ran. object initialized.')
         self.max_downloads = int(self.config.get('download', 'max_downloads'))
         self.num_streams = int(self.config.get('download', 'num_streams'))
+        self.max_inflight = int(float(self.config.get('download', 'max_inflight_gb')) * GB)
 
     def execute(self, dolist):
         '''
         Perform one run for stage.  
+        Downloads every run of each project, max_downloads at a time, smallest first 
+        with projects taking turns (see download.DownloadScheduler). 
+        Projects whose runs all downloaded are done. 
+
+        Each project's missing runs are reserved in the cache budget as a whole before any 
+        starts, so a started project can always finish. Only the first project waits for 
+        space (other projects' files being aligned and evicted). Projects that don't fit are 
+        deferred, they stay todo. A project bigger than the whole budget can never fit, so 
+        it is downloaded regardless. 
         '''
         self.log.debug(f'executing {self.name}')
         outlist = []
         runlist = []
-        dq = Queue()
+        projruns = {}
+        ds = DownloadScheduler(self.max_downloads, self.max_inflight)
+        cache = get_cache(self.config)
+        cachedir = os.path.expanduser(self.config.get('download', 'cachedir'))
+        admitted = 0
         for projectid in dolist:
-            runids = sra.get_runs_for_project(self.config, projectid)
-            self.log.debug(f'got runids to prefetch: {runids}')
+            runids = sra.get_runs_for_project(self.config, projectid, screen=True)
+            self.log.debug(f'got runids to download: {runids}')
+            urls = sra.get_run_urls(self.config, projectid)
+            sizes = sra.get_run_sizes(self.config, projectid)
+            projruns[projectid] = runids
+            if len(runids) == 0 and len(sra.get_runs_for_project(self.config, projectid)) > 0:
+                self.log.info(f'all runs of {projectid} screened out. nothing to download.')
+                outlist.append(projectid)
+            runsizes = {}
             for runid in runids:
-                projfetch = sra.ProjectPrefetch(self.config, projid, outlist)
-                #pf = sra.Prefetch(self.config, runid, outlist)
-                dq.put(pf)
-            outlist.append(projectid)
-        logging.debug(f'created queue of {dq.qsize()} items')
-        md = int(self.config.get('sra', 'max_downloads'))
-        for n in range(md):
-            sra.Worker(dq).start()
-        logging.debug('waiting to join threads...')
-        dq.join()
-        logging.debug('all workers done...')
-        logging.info(f'prefetched runs: {runlist}')
+                (url, md5, size) = urls.get(runid, (None, None, 0))
+                runsizes[runid] = sizes.get(runid, size)
+            missing = [r for r in runids if not os.path.exists(sra.sra_path(cachedir, r))]
+            need = sum(runsizes[r] for r in missing)
+            force = cache.budget > 0 and sum(runsizes.values()) > cache.budget
+            if force:
+                self.log.warning(f'{projectid} is larger than the cache budget. not waiting for space.')
+            # the batch's own files can't be evicted before it returns.
+            if not cache.reserve(need, set(dolist), force, None if admitted == 0 else 0):
+                self.log.info(f'no cache space for {projectid}. deferred.')
+                continue
+            admitted += 1
+            for runid in runids:
+                (url, md5, size) = urls.get(runid, (None, None, 0))
+                ds.add(sra.DownloadRun(self.config, runid, runlist, url, md5, runsizes[runid],
+                                       projectid, reserved=runid in missing))
+        ds.run()
+        logging.info(f'downloaded runs: {runlist}')
+        for projectid in dolist:
+            runids = projruns[projectid]
+            if projectid in outlist:
+                continue
+            if len(runids) > 0 and set(runids).issubset(runlist):
+                outlist.append(projectid)
+            else:
+                self.log.warning(f'incomplete download for {projectid}. will retry.')
         return outlist
 
 
@@ -235,9 +384,34 @@ class Analysis(Stage):
     def __init__(self, config):
         super(Analysis, self).__init__(config, 'analysis')
         self.log.debug('super() ran. object initialized.')
+        # one scheduler for the node, shared by all pipeline workers of this stage.
+        self.scheduler = star.AlignScheduler(self.config)
 
-    def execute(self):
-        pass
+    def execute(self, dolist):
+        '''
+        Align the runs of all projects concurrently, packed onto the node's cores and 
+        memory (see star.AlignScheduler). Projects with every supported run aligned are done. 
+        '''
+        self.log.debug(f'executing {self.name}')
+        outlist = []
+        alljobs = []
+        projjobs = {}
+        for projectid in dolist:
+            try:
+                jobs = star.AlignReads(self.config, projectid).jobs()
+            except Exception as ex:
+                self.log.error(f'problem aligning {projectid}: {ex}')
+                logging.error(traceback.format_exc(None))
+                continue
+            projjobs[projectid] = jobs
+            alljobs.extend(jobs)
+        self.scheduler.run(alljobs)
+        for (projectid, jobs) in projjobs.items():
+            if all(job.ok for job in jobs):
+                outlist.append(projectid)
+            else:
+                self.log.warning(f'alignment incomplete for {projectid}. will retry.')
+        return outlist
 
     def setup(self):
         star.setup(self.config)
@@ -246,11 +420,11 @@ class Analysis(Stage):
 class Statistics(Stage):
 
     def __init__(self, config):
-        super(Statistics, self).__init__(config, 'analysis')
+        super(Statistics, self).__init__(config, 'statistics')
         self.log.debug('super() ran. object initialized.')
 
-    def execute(self):
-        pass
+    def execute(self, dolist):
+        return []
 
     def setup(self):
         pass
@@ -258,6 +432,203 @@ class Statistics(Stage):
 
 
 
+class Pipeline(object):
+    '''
+    Runs all stages in one process, connected by bounded in-memory queues. 
+
+    Each stage gets [<stage>] pipeline_workers threads, each handling up to batchsize ids 
+    per execute(). Finished ids are appended to the stage's donefile (for durability and 
+    restart) and then put on the next stage's queue, which holds at most [<stage>] queuesize 
+    ids. A full queue blocks the upstream stage, e.g. download can't get more than a few 
+    projects ahead of analysis. 
+
+    On start, each downstream stage is seeded from its todofile minus donefile, so a 
+    restart picks up where the daemons or a previous pipeline left off. These are read 
+    before any worker starts, so an id finished upstream meanwhile is queued only once. 
+    The query stage's 
+    todofile is re-read every cycle as in Stage.run(). After ncycles, a stop marker is 
+    passed down the pipeline once each stage has drained. 
+
+    Ids a downstream stage fails on are put back on its queue after [<stage>] sleep, 
+    as the daemon's next cycle would retry them. Failed query ids are picked up again 
+    by the next re-read of its todofile. Retries still waiting when a stage stops stay 
+    in todo minus done for the next run. 
+    '''
+    STOP = None
+    STAGES = [Query, Impute, Download, Analysis, Statistics]
+
+    def __init__(self, config):
+        self.log = logging.getLogger('pipeline')
+        self.config = config
+        self.stages = [sclass(config) for sclass in self.STAGES]
+        self.queues = []
+        self.nworkers = []
+        for st in self.stages:
+            self.queues.append(Queue(maxsize=int(config.get(st.name, 'queuesize'))))
+            self.nworkers.append(int(config.get(st.name, 'pipeline_workers')))
+        # per stage: serializes donefile appends, counts workers that have seen STOP.
+        self.locks = [threading.Lock() for st in self.stages]
+        self.stopped = [0 for st in self.stages]
+        self.seeders = [None for st in self.stages]
+        # per stage: timers that will re-queue failed ids.
+        self.retries = [set() for st in self.stages]
+        # ids fed to query stage but not yet done, so re-reads of todofile don't repeat them.
+        self.feeding = set()
+
+    def _pending(self, i):
+        st = self.stages[i]
+        st.todo.refresh()
+        st.done.refresh()
+        pending = [x for x in st.todo.items if x not in st.done.itemset]
+        pending.sort()
+        return pending
+
+    def _seed(self, i, pending):
+        '''
+        Queue ids read by _pending(i). In a thread, since the queue is bounded. 
+        '''
+        self.log.info(f'seeding {self.stages[i].name} with {len(pending)} pending ids')
+        for x in pending:
+            self.queues[i].put(x)
+
+    def _feed(self):
+        '''
+        Source for first stage: its todofile, re-read each cycle. 
+        '''
+        st = self.stages[0]
+        watcher = TodoWatcher(st.todofile, st.wakeup, st.pollinterval)
+        cycles = 0
+        while True:
+            watcher.mark()
+            st.todo.refresh()
+            with self.locks[0]:
+                st.done.refresh()
+                new = [x for x in st.todo.items
+                       if x not in st.done.itemset and x not in self.feeding]
+                self.feeding.update(new)
+            new.sort()
+            self.log.info(f'feeding {len(new)} new ids to {st.name}')
+            for x in new:
+                self.queues[0].put(x)
+            cycles += 1
+            if cycles >= st.ncycles:
+                break
+            watcher.wait(st.sleep)
+        self.queues[0].put(self.STOP)
+
+    def _retry(self, i, ids):
+        '''
+        Put ids that stage i failed on back on its queue after the stage's sleep. 
+        '''
+        st = self.stages[i]
+        with self.locks[i]:
+            if self.stopped[i] > 0:
+                st.log.info(f'stopping, {len(ids)} failed ids left for next run: {ids}')
+                return
+            t = threading.Timer(st.sleep, self._requeue, args=(i, ids))
+            t.daemon = True
+            self.retries[i].add(t)
+        st.log.info(f'will retry {len(ids)} ids in {st.sleep} sec: {ids}')
+        t.start()
+
+    def _requeue(self, i, ids):
+        with self.locks[i]:
+            self.retries[i].discard(threading.current_thread())
+            if self.stopped[i] > 0:
+                return
+        for x in ids:
+            self.queues[i].put(x)
+
+    def _take(self, i):
+        '''
+        Block for one id, then take whatever else is queued up to batchsize. 
+        '''
+        q = self.queues[i]
+        batch = [q.get()]
+        while batch[-1] is not self.STOP and len(batch) < self.stages[i].batchsize:
+            try:
+                batch.append(q.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _stop(self, i):
+        '''
+        Worker of stage i saw STOP. Last one out passes it downstream. 
+        '''
+        with self.locks[i]:
+            self.stopped[i] += 1
+            last = self.stopped[i] == self.nworkers[i]
+            if last:
+                for t in self.retries[i]:
+                    t.cancel()
+                    self.stages[i].log.info(f'stopping, failed ids left for next run: {t.args[1]}')
+                self.retries[i].clear()
+        if not last:
+            self.queues[i].put(self.STOP)
+        elif i + 1 < len(self.stages):
+            # anything seeded from files must go ahead of STOP.
+            self.seeders[i + 1].join()
+            self.queues[i + 1].put(self.STOP)
+
+    def _work(self, i):
+        st = self.stages[i]
+        while True:
+            batch = self._take(i)
+            stop = self.STOP in batch
+            batch = [x for x in batch if x is not self.STOP]
+            if len(batch) > 0:
+                try:
+                    finished = st.execute(batch)
+                except Exception as ex:
+                    st.log.warning(f'exception raised during execute: {batch}')
+                    st.log.error(traceback.format_exc(None))
+                    finished = []
+                finished = [x for x in finished if x is not None]
+                with self.locks[i]:
+                    st.done.append(finished)
+                    st.done.compact()
+                    if i == 0:
+                        self.feeding.difference_update(batch)
+                failed = [x for x in batch if x not in finished]
+                if i > 0 and len(failed) > 0:
+                    self._retry(i, failed)
+                if i + 1 < len(self.stages):
+                    for x in finished:
+                        self.queues[i + 1].put(x)
+            if stop:
+                self._stop(i)
+                return
+
+    def run(self):
+        self.log.info('pipeline run...')
+        threads = []
+        # snapshot every stage's backlog before any worker can add to the donefiles.
+        pending = [self._pending(i) for i in range(len(self.stages))]
+        for i in range(1, len(self.stages)):
+            self.seeders[i] = threading.Thread(target=self._seed, args=(i, pending[i]),
+                                               daemon=True)
+            self.seeders[i].start()
+        threads.append(threading.Thread(target=self._feed, daemon=True))
+        for (i, st) in enumerate(self.stages):
+            for n in range(self.nworkers[i]):
+                threads.append(threading.Thread(target=self._work, args=(i,),
+                                                name=f'{st.name}-{n}', daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+        except KeyboardInterrupt:
+            print('\nCtrl-C. stopping.')
+        logging.info('Shutdown set. Exitting pipeline')
+
+    def setup(self):
+        for st in self.stages:
+            st.setup()
+
+
 class CLI(object):
 
     def parseopts(self):
@@ -314,6 +685,9 @@ class CLI(object):
         parser_analysis = subparsers.add_parser('statistics',
                                                 help='statistics daemon')
 
+        parser_all = subparsers.add_parser('all',
+                                           help='all stages in one process')
+
         args = parser.parse_args()
 
         # default to INFO
@@ -369,6 +743,13 @@ class CLI(object):
             else:
                 d.run()
 
+        if args.subcommand == 'all':
+            d = Pipeline(cp)
+            if args.setup:
+                d.setup()
+            else:
+                d.run()
+
 
     def get_configstr(self, cp):
         with io.StringIO() as ss:
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+#
+#  Native parallel HTTP range downloader for SRA run files.
+#
+#  A file is fetched as fixed-size chunks over several concurrent range requests,
+#  written in place into <outfile>.part. Finished chunks are recorded in a journal
+#  (<outfile>.journal), so an interrupted download resumes where it left off.
+#  The finished file is checked for size and md5 before being renamed into place.
+#
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scqc.eutils import RETRY_EXCEPTIONS, retry_request, sleeptime
+from scqc.utils import TrackedList
+
+MB = 1024 * 1024
+
+
+class DownloadVerifyException(Exception):
+    """ Thrown when a finished download fails the size or md5 check.  """
+
+
+class ChunkJournal(object):
+    '''
+    Finished chunk indices for one partial download, one per line, appended as
+    chunks complete. The first line identifies the target (size and chunk size).
+    A journal written for a different target is discarded along with the partial file.
+    '''
+
+    def __init__(self, journalfile, size, chunksize):
+        self.log = logging.getLogger('download')
+        self.journalfile = journalfile
+        self.header = f'# size={size} chunksize={chunksize}'
+        self.lock = threading.Lock()
+        self.tracked = TrackedList(journalfile)
+        items = self.tracked.refresh()
+        self.valid = len(items) > 0 and items[0] == self.header
+        if not self.valid:
+            if len(items) > 0:
+                self.log.info(f'journal {journalfile} is for another target. restarting.')
+            self.reset()
+
+    def reset(self):
+        '''
+        Forget all finished chunks, e.g. when the partial file they were written to is gone.
+        '''
+        self.remove()
+        self.tracked = TrackedList(self.journalfile)
+        self.tracked.append([self.header])
+        self.valid = False
+
+    def done(self):
+        return set(int(i) for i in self.tracked.items[1:])
+
+    def mark(self, i):
+        with self.lock:
+            self.tracked.append([str(i)])
+
+    def remove(self):
+        try:
+            os.remove(self.journalfile)
+        except FileNotFoundError:
+            pass
+
+
+class RangeDownloader(object):
+    '''
+    Downloads url to outfile with <streams> concurrent range requests of <chunksize> bytes.
+    Falls back to a single streamed GET if the server gives no length or range support
+    (not resumable).
+
+    Chunk requests are retried on RETRY_CODES and connection errors, with exponential backoff.
+    '''
+
+    def __init__(self, chunksize=64 * MB, streams=4, max_tries=5, backoff=1.0, timeout=300):
+        self.log = logging.getLogger('download')
+        self.chunksize = int(chunksize)
+        self.streams = int(streams)
+        self.max_tries = int(max_tries)
+        self.backoff = float(backoff)
+        self.timeout = float(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.streams,
+                              pool_maxsize=self.streams)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def fetch(self, url, outfile, md5=None, size=None, slack=0):
+        '''
+        Download url to outfile, resuming any earlier partial download.
+        md5 and size (metadata bytes, matched within slack bytes), if given, are checked
+        against the finished file. The server's Content-Length must match exactly.
+        Raises DownloadVerifyException on mismatch (partial state is removed).
+        Returns outfile
+        '''
+        start = time.time()
+        (length, ranges) = self._probe(url)
+        if size is not None and length is not None and abs(int(size) - length) > slack:
+            raise DownloadVerifyException(
+                f'{url} is {length} bytes, metadata says {size}')
+        partfile = f'{outfile}.part'
+        journalfile = f'{outfile}.journal'
+        if length is None or not ranges:
+            self.log.info(f'no range support for {url}. single stream download.')
+            self._fetch_whole(url, partfile)
+        else:
+            self._fetch_chunks(url, partfile, journalfile, length)
+        if length is not None:
+            self._verify(partfile, journalfile, md5, length)
+        else:
+            self._verify(partfile, journalfile, md5, size, slack)
+        os.replace(partfile, outfile)
+        self._remove(journalfile)
+        took = time.time() - start
+        nbytes = os.path.getsize(outfile)
+        self.log.info(f'downloaded {outfile} {nbytes / MB:.1f}MB in {took:.1f}s')
+        return outfile
+
+    def _probe(self, url):
+        '''
+        HEAD for length and range support. (None, False) if unknown.
+        '''
+        r = self._request('HEAD', url, allow_redirects=True)
+        if r.status_code != 200:
+            self.log.warning(f'HEAD {url} returned {r.status_code}')
+            return (None, False)
+        length = r.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            return (None, False)
+        ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return (int(length), ranges)
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return retry_request(lambda: self.session.request(method, url, **kwargs), url,
+                             self.max_tries, self.backoff, self.log)
+
+    def _fetch_whole(self, url, partfile):
+        r = self._request('GET', url, stream=True)
+        if r.status_code != 200:
+            raise IOError(f'GET {url} returned {r.status_code}')
+        with open(partfile, 'wb') as f:
+            for data in r.iter_content(chunk_size=MB):
+                f.write(data)
+
+    def _remove(self, *paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _fetch_chunks(self, url, partfile, journalfile, length):
+        journal = ChunkJournal(journalfile, length, self.chunksize)
+        if journal.valid and (not os.path.exists(partfile) or
+                              os.path.getsize(partfile) != length):
+            # chunks were recorded against a partial file that is gone or truncated.
+            self.log.info(f'{partfile} missing or wrong size. restarting {url}.')
+            journal.reset()
+        if not journal.valid:
+            self._remove(partfile)
+        nchunks = (length + self.chunksize - 1) // self.chunksize
+        done = journal.done()
+        todo = [i for i in range(nchunks) if i not in done]
+        self.log.debug(f'{url} {nchunks} chunks, {len(done)} already done.')
+
+        fd = os.open(partfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != length:
+                os.ftruncate(fd, length)
+
+            def getchunk(i):
+                cstart = i * self.chunksize
+                cend = min(length, cstart + self.chunksize) - 1
+                self._fetch_range(url, fd, cstart, cend)
+                journal.mark(i)
+
+            with ThreadPoolExecutor(max_workers=self.streams) as pool:
+                # list() re-raises the first chunk failure, after the others finish.
+                list(pool.map(getchunk, todo))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _fetch_range(self, url, fd, cstart, cend):
+        '''
+        Fetch bytes cstart..cend (inclusive) into fd at the same offset.
+        A short read is retried from where it stopped.
+        '''
+        offset = cstart
+        attempt = 0
+        while offset <= cend:
+            try:
+                r = self._request('GET', url, stream=True,
+                                  headers={'Range': f'bytes={offset}-{cend}'})
+                if r.status_code != 206:
+                    raise IOError(f'range GET {url} returned {r.status_code}')
+                for data in r.iter_content(chunk_size=MB):
+                    data = data[:cend + 1 - offset]
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+            except RETRY_EXCEPTIONS as ex:
+                self.log.warning(f'{type(ex).__name__} at {offset} of {url}')
+            if offset <= cend:
+                attempt += 1
+                if attempt >= self.max_tries:
+                    raise IOError(f'unable to get bytes {offset}-{cend} of {url}')
+                time.sleep(sleeptime(self.backoff, attempt))
+
+    def _verify(self, partfile, journalfile, md5, size, slack=0):
+        '''
+        On failure both the partial file and its journal are removed, so the next
+        fetch starts over rather than trusting chunks that produced a bad file.
+        '''
+        nbytes = os.path.getsize(partfile)
+        if size is not None and abs(nbytes - int(size)) > slack:
+            self._remove(partfile, journalfile)
+            raise DownloadVerifyException(f'{partfile} is {nbytes} bytes, expected {size}')
+        if md5 is not None:
+            h = hashlib.md5()
+            with open(partfile, 'rb') as f:
+                for data in iter(lambda: f.read(8 * MB), b''):
+                    h.update(data)
+            if h.hexdigest().lower() != md5.lower():
+                self._remove(partfile, journalfile)
+                raise DownloadVerifyException(
+                    f'{partfile} md5 {h.hexdigest()} != {md5}')
+
+
+class DownloadScheduler(object):
+    '''
+    Runs download jobs (anything with execute(), size and proj_id) on up to max_jobs threads.
+    execute() returns the bytes it actually downloaded (0 if it failed).
+
+    Order: the project that has been given the fewest bytes so far goes next (fairness),
+    and within a project the smallest run goes first (shortest job first, so more runs
+    finish per hour). Runs of unknown size (0) go last in their project.
+    A job only starts if it keeps bytes in flight under max_inflight (0 for no cap),
+    unless nothing else is running.
+
+    Aggregate throughput is measured from finished jobs, giving a per-project eta().
+    '''
+
+    def __init__(self, max_jobs=2, max_inflight=0):
+        self.log = logging.getLogger('download')
+        self.max_jobs = int(max_jobs)
+        self.max_inflight = int(max_inflight)
+        self.queues = {}
+        self.served = {}
+        self.remaining = {}
+        self.running = 0
+        self.inflight = 0
+        self.done_bytes = 0
+        self.start = None
+        self.cond = threading.Condition()
+
+    def add(self, job):
+        with self.cond:
+            self.queues.setdefault(job.proj_id, []).append(job)
+            self.served.setdefault(job.proj_id, 0)
+            self.remaining[job.proj_id] = self.remaining.get(job.proj_id, 0) + job.size
+            self.cond.notify_all()
+
+    def _sortkey(self, job):
+        if job.size > 0:
+            return job.size
+        return float('inf')
+
+    def _next(self):
+        '''
+        Pop the next job to start, or None if nothing may start now. Holds cond.
+        '''
+        if self.running >= self.max_jobs:
+            return None
+        heads = []
+        for (proj_id, q) in self.queues.items():
+            if len(q) > 0:
+                job = min(q, key=self._sortkey)
+                heads.append((self.served[proj_id], self._sortkey(job), job))
+        if len(heads) == 0:
+            return None
+        (served, key, job) = min(heads, key=lambda h: h[:2])
+        fits = self.max_inflight <= 0 or self.inflight + job.size <= self.max_inflight
+        if not fits and self.running > 0:
+            return None
+        self.queues[job.proj_id].remove(job)
+        return job
+
+    def run(self):
+        '''
+        Execute all added jobs. Returns when every job has finished.
+        '''
+        self.start = time.time()
+        threads = []
+        with self.cond:
+            while True:
+                job = self._next()
+                if job is None:
+                    if self.running == 0 and not any(self.queues.values()):
+                        break
+                    self.cond.wait()
+                    continue
+                self.running += 1
+                self.inflight += job.size
+                self.served[job.proj_id] += job.size
+                t = threading.Thread(target=self._execute, args=(job,))
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+        took = time.time() - self.start
+        self.log.info(f'downloads done. {self.done_bytes / MB:.1f}MB in {took:.1f}s')
+
+    def _execute(self, job):
+        nbytes = 0
+        try:
+            nbytes = job.execute() or 0
+        except Exception as ex:
+            self.log.error(f'download job for {job.proj_id} failed: {ex}')
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.inflight -= job.size
+                self.remaining[job.proj_id] -= job.size
+                # failures finish early and would inflate the measured rate.
+                self.done_bytes += nbytes
+                nleft = len(self.queues[job.proj_id])
+                eta = self.eta(job.proj_id)
+                self.cond.notify_all()
+            if eta is not None:
+                self.log.info(f'{job.proj_id}: {nleft} runs queued, eta {eta:.0f}s')
+
+    def throughput(self):
+        '''
+        Measured bytes/second over all finished jobs. None before any bytes finish.
+        '''
+        if self.start is None or self.done_bytes == 0:
+            return None
+        return self.done_bytes / max(time.time() - self.start, 1e-3)
+
+    def eta(self, proj_id):
+        '''
+        Estimated seconds until all of proj_id's runs are downloaded, at the measured
+        throughput. None if not yet measurable.
+        '''
+        rate = self.throughput()
+        if rate is None:
+            return None
+        return self.remaining.get(proj_id, 0) / rate
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+#  Shared HTTP client for NCBI E-utilities and SRA trace queries.
+#
+#  NCBI allows 3 requests/second per host, 10 with an API key. All query paths
+#  go through one pooled keep-alive session and one token bucket per process,
+#  so concurrent threads (or asyncio tasks) together stay under the limit.
+#
+# https://www.ncbi.nlm.nih.gov/books/NBK25497/#chapter2.Usage_Guidelines_and_Requiremen
+#
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+# NCBI request budgets, requests per second.
+DEFAULT_RATE = 3.0
+APIKEY_RATE = 10.0
+
+# HTTP codes worth retrying. Anything else is returned to the caller as-is.
+RETRY_CODES = [429, 500, 502, 503, 504]
+RETRY_EXCEPTIONS = (ChunkedEncodingError, ConnectionError, Timeout)
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket.
+    Tokens refill at <rate> per second up to <capacity>.
+    reserve() takes a token immediately and returns how long the caller must wait
+    before using it, so both blocking and asyncio callers can share one bucket.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def sleeptime(backoff, attempt, r=None):
+    '''
+    Honor Retry-After if the server sent one, otherwise exponential with jitter.
+    '''
+    if r is not None:
+        ra = r.headers.get('Retry-After')
+        if ra is not None and ra.isdigit():
+            return float(ra)
+    return backoff * (2 ** attempt) * (1 + random.random() * 0.1)
+
+
+def retry_delay(attempt, max_tries, backoff, url, log, r=None, ex=None):
+    '''
+    After failed attempt number <attempt> (response r with a RETRY_CODES status, or
+    exception ex), seconds to wait before trying again. None once max_tries is reached.
+    '''
+    if r is not None:
+        why = f'HTTP {r.status_code}'
+    else:
+        why = f'{type(ex).__name__}'
+    if attempt >= max_tries:
+        log.warning(f'giving up on {url} after {attempt} tries: {why}')
+        return None
+    wait = sleeptime(backoff, attempt, r)
+    log.warning(f'{why} for {url}. try {attempt}, retry in {wait:.1f}s')
+    return wait
+
+
+def retry_request(send, url, max_tries, backoff, log, before=None):
+    '''
+    Call send() (returns a requests response) until it gives a status not in RETRY_CODES.
+    Retries RETRY_CODES and RETRY_EXCEPTIONS up to max_tries, then returns the last
+    response or re-raises the last exception. before(), if given, is called ahead of
+    every attempt (e.g. to wait for a rate token).
+    '''
+    attempt = 0
+    while True:
+        if before is not None:
+            before()
+        try:
+            r = send()
+        except RETRY_EXCEPTIONS as ex:
+            attempt += 1
+            wait = retry_delay(attempt, max_tries, backoff, url, log, ex=ex)
+            if wait is None:
+                raise ex
+            time.sleep(wait)
+            continue
+        if r.status_code in RETRY_CODES:
+            attempt += 1
+            wait = retry_delay(attempt, max_tries, backoff, url, log, r=r)
+            if wait is None:
+                return r
+            r.close()
+            time.sleep(wait)
+            continue
+        return r
+
+
+class EUtilsClient(object):
+    '''
+    Pooled, rate-limited, retrying HTTP client.
+    Use get_client(config) to get the process-wide shared instance.
+
+    Config [sra] options:
+        api_key         NCBI API key or 'none'. Sent with every request when set.
+        max_rate        requests/sec. defaults to 3, or 10 with api_key.
+        max_inflight    connection pool size and asyncio worker count.
+        max_tries       attempts per request for 429/5xx and connection errors.
+        backoff         base seconds for exponential backoff between attempts.
+        http_timeout    seconds to wait for connect/read.
+
+    '''
+
+    def __init__(self, config=None):
+        self.log = logging.getLogger('eutils')
+        self.api_key = self._getopt(config, 'api_key', 'none')
+        if self.api_key.lower().strip() == 'none':
+            self.api_key = None
+        if self.api_key is None:
+            defrate = DEFAULT_RATE
+        else:
+            defrate = APIKEY_RATE
+        self.max_rate = float(self._getopt(config, 'max_rate', defrate))
+        self.max_inflight = int(self._getopt(config, 'max_inflight', 4))
+        self.max_tries = int(self._getopt(config, 'max_tries', 5))
+        self.backoff = float(self._getopt(config, 'backoff', 1.0))
+        self.timeout = float(self._getopt(config, 'http_timeout', 300))
+
+        self.bucket = TokenBucket(self.max_rate)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_inflight,
+                              pool_maxsize=self.max_inflight)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = None
+        self.log.debug(
+            f'client rate={self.max_rate}/s inflight={self.max_inflight} tries={self.max_tries}')
+
+    def _getopt(self, config, key, default):
+        if config is not None and config.has_option('sra', key):
+            return config.get('sra', key)
+        return default
+
+    def _add_key(self, kwargs):
+        if self.api_key is not None:
+            params = dict(kwargs.get('params') or {})
+            params['api_key'] = self.api_key
+            kwargs['params'] = params
+        return kwargs
+
+    def request(self, method, url, **kwargs):
+        '''
+        Blocking request. Waits for a rate token before every attempt.
+        Retries RETRY_CODES and RETRY_EXCEPTIONS up to max_tries, then returns the last
+        response (caller checks status_code) or re-raises the last exception.
+        '''
+        kwargs = self._add_key(kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        return retry_request(lambda: self.session.request(method, url, **kwargs), url,
+                             self.max_tries, self.backoff, self.log, before=self.bucket.acquire)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    async def arequest(self, method, url, **kwargs):
+        '''
+        asyncio version of request(). Waits for its rate token on the event loop, then runs
+        the pooled-session call on a bounded executor, so up to max_inflight requests
+        can be outstanding while still sharing the one bucket.
+        '''
+        kwargs = self._add_key(kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_inflight)
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            await self.bucket.acquire_async()
+            try:
+                r = await loop.run_in_executor(
+                    self.executor,
+                    lambda: self.session.request(method, url, **kwargs))
+            except RETRY_EXCEPTIONS as ex:
+                attempt += 1
+                wait = retry_delay(attempt, self.max_tries, self.backoff, url, self.log, ex=ex)
+                if wait is None:
+                    raise ex
+                await asyncio.sleep(wait)
+                continue
+            if r.status_code in RETRY_CODES:
+                attempt += 1
+                wait = retry_delay(attempt, self.max_tries, self.backoff, url, self.log, r=r)
+                if wait is None:
+                    return r
+                r.close()
+                await asyncio.sleep(wait)
+                continue
+            return r
+
+    def gather(self, method, urls, **kwargs):
+        '''
+        Issue requests for all urls concurrently (within rate and inflight limits).
+        Returns list in the same order as urls. Failed requests are returned as the
+        raised exception rather than aborting the rest.
+        '''
+        async def _all():
+            tasks = [self.arequest(method, url, **kwargs) for url in urls]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        return asyncio.run(_all())
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(config=None):
+    '''
+    Return the process-wide client, creating it from config on first use.
+    One instance per process means one token bucket for every in-flight request.
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = EUtilsClient(config)
+        return _client
@@ -1,6 +1,8 @@
 
 import argparse
+import ast
 import glob
+import hashlib
 import io
 import itertools
 import json
@@ -10,8 +12,10 @@ import re
 import requests
 import subprocess
 import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from configparser import ConfigParser
 from threading import Thread
@@ -19,13 +23,16 @@ from queue import Queue, Empty
 from requests.exceptions import ChunkedEncodingError
 
 import xml.etree.ElementTree as et
-import pandas as pd
-import numpy as np
 
 gitpath = os.path.expanduser("~/git/scqc")
 sys.path.append(gitpath)
 
 from scqc.utils import *
+# heavy, imported on first use
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+from scqc.metastore import get_store
+from scqc.sra import screen_runs
 
 LOGLEVELS = {
     10: 'debug',
@@ -44,7 +51,7 @@ EXP_COLUMNS = ['exp_id', 'ext_ids',  'strategy',
                'source', 'lcp', 'samp_id', 'proj_id', 'submission_id']
 
 RUN_COLUMNS = ['run_id', 'ext_ids', 'tot_spots', 'tot_bases', 'size', 'publish_date',
-               'taxon', 'organism', 'nreads',  'basecounts', 'exp_id', 'samp_id', 'proj_id', 'submission_id']
+               'taxon', 'organism', 'nreads',  'basecounts', 'read_lengths', 'exp_id', 'samp_id', 'proj_id', 'submission_id']
 
 IMPUTE_COLUMNS = ['run_id' ,'tech_version','read1','read2','exp_id','samp_id','proj_id', 'taxon','batch']
 
@@ -69,11 +76,188 @@ TECH_RES = {
 }
 
 
+REGEX_META = re.compile(r'[.^$*+?{}\[\]\\()]')
+
+
+class TechMatcher(object):
+    '''
+    Matches text against a {tech: compiled regex} rule set in one pass. 
+
+    Patterns that are plain case-insensitive keyword alternations become keyword lists, 
+    checked with substring search on lowercased text. Everything else is compiled into 
+    one alternation with a named group per tech. 
+    version is a hash of the rule set, so cached results can be tied to the rules. 
+    '''
+
+    def __init__(self, techres):
+        self.techres = techres
+        self.keywords = {}
+        self.groups = {}
+        alts = []
+        for i, (key, rx) in enumerate(techres.items()):
+            if rx.flags & re.IGNORECASE and not REGEX_META.search(rx.pattern):
+                self.keywords[key] = [ kw.lower() for kw in rx.pattern.split('|') ]
+                continue
+            name = f't{i}'
+            self.groups[name] = key
+            if rx.flags & re.IGNORECASE:
+                alts.append(f'(?P<{name}>(?i:{rx.pattern}))')
+            else:
+                alts.append(f'(?P<{name}>{rx.pattern})')
+        self.matcher = None
+        if len(alts) > 0:
+            self.matcher = re.compile('|'.join(alts))
+        rules = [ [key, rx.pattern, int(rx.flags)] for key, rx in techres.items() ]
+        self.version = hashlib.sha1(json.dumps(rules).encode('utf-8')).hexdigest()[:12]
+
+    def match(self, text):
+        '''
+        All techs whose pattern is found in text, in rule set order. 
+        Non-literal patterns get one scan with the combined matcher. Searching resumes 
+        one past each hit so overlapping matches are found, and techs not yet seen are 
+        checked at the hit position, since the matcher only reports the first alternative there. 
+        '''
+        low = text.lower()
+        found = set( key for key, kws in self.keywords.items() if any(kw in low for kw in kws) )
+        if self.matcher is not None:
+            m = self.matcher.search(text)
+            while m is not None:
+                found.add(self.groups[m.lastgroup])
+                pos = m.start()
+                for key in self.groups.values():
+                    if key not in found and self.techres[key].match(text, pos):
+                        found.add(key)
+                m = self.matcher.search(text, pos + 1)
+        return tuple(key for key in self.techres if key in found)
+
+
+def normalize_lcp(lcp):
+    '''
+    Collapse whitespace so re-flowed copies of the same protocol text share an entry.
+    '''
+    return ' '.join(lcp.split())
+
+
+def lcp_hash(lcp):
+    return hashlib.sha1(normalize_lcp(lcp).encode('utf-8')).hexdigest()
+
+
+class LCPCache(object):
+    '''
+    Persistent normalized lcp hash -> matched techs, for one TechMatcher rule set. 
+
+    Stored as a list file of <rules version> <lcp hash> <tech,tech,...|-> lines, 
+    appended via TrackedList so concurrent imputers only add lines. 
+    Entries from other rule versions are ignored, and dropped from the file once they 
+    outnumber current ones, so editing the rules invalidates the cache automatically. 
+    cachefile None keeps the cache in memory only. 
+    '''
+
+    def __init__(self, cachefile, matcher):
+        self.log = logging.getLogger('impute')
+        self.cachefile = cachefile
+        self.matcher = matcher
+        self.lock = threading.Lock()
+        self.tracked = TrackedList(cachefile)
+        self._reset()
+        self.refresh()
+        if self.stale > len(self.techs):
+            self._drop_stale()
+
+    def refresh(self):
+        '''
+        Pick up entries other processes appended since the last refresh. 
+        '''
+        with self.lock:
+            inode = self.tracked.inode
+            items = self.tracked.refresh()
+            if self.tracked.inode != inode:
+                # file was replaced (compacted), TrackedList re-read it from the start.
+                self._reset()
+            for line in items[self.nread:]:
+                fields = line.split('\t')
+                if len(fields) != 3 or fields[0] != self.matcher.version:
+                    self.stale += 1
+                    continue
+                self.techs[fields[1]] = tuple(t for t in fields[2].split(',') if t != '-')
+            self.nread = len(items)
+            self.log.debug(f'{len(self.techs)} cached lcps, {self.stale} stale in {self.cachefile}')
+
+    def _reset(self):
+        self.techs = {}
+        self.stale = 0
+        self.nread = 0
+
+    def _line(self, h, techs):
+        if len(techs) == 0:
+            return f'{self.matcher.version}\t{h}\t-'
+        return f'{self.matcher.version}\t{h}\t{",".join(techs)}'
+
+    def _drop_stale(self):
+        self.log.info(f'dropping {self.stale} stale lcp entries from {self.cachefile}')
+        current = [ self._line(h, t) for h, t in self.techs.items() ]
+        writelist(self.cachefile, sorted(current))
+        self.tracked = TrackedList(self.cachefile)
+        self._reset()
+        self.refresh()
+
+    def lookup(self, lcps):
+        '''
+        Matched techs tuple for each lcp. Only lcps not seen before are matched, 
+        and those results are appended to the cache file. 
+        '''
+        hashes = [ lcp_hash(lcp) for lcp in lcps ]
+        out = []
+        new = {}
+        with self.lock:
+            for lcp, h in zip(lcps, hashes):
+                techs = self.techs.get(h)
+                if techs is None:
+                    techs = new.get(h)
+                if techs is None:
+                    techs = self.matcher.match(normalize_lcp(lcp))
+                    new[h] = techs
+                out.append(techs)
+            if len(new) > 0:
+                self.log.debug(f'matched {len(new)} new lcps of {len(lcps)}')
+                lines = [ self._line(h, t) for h, t in new.items() ]
+                try:
+                    self.tracked.append(lines)
+                except OSError:
+                    self.log.warning(f'unable to append to lcp cache {self.cachefile}')
+                self.techs.update(new)
+        return out
+
+
+TECH_MATCHER = TechMatcher(TECH_RES)
+
+# cachefile -> LCPCache. one per process, shared by all Impute instances.
+LCP_CACHES = {}
+LCP_CACHES_LOCK = threading.Lock()
+
+
+def get_lcp_cache(cachefile, matcher=TECH_MATCHER):
+    with LCP_CACHES_LOCK:
+        if cachefile not in LCP_CACHES:
+            LCP_CACHES[cachefile] = LCPCache(cachefile, matcher)
+        return LCP_CACHES[cachefile]
+
+
+def classify_techs(techs):
+    '''
+    Tech for one matched techs tuple: the single matching tech, 'multiple' or 'unknown'. 
+    '''
+    if len(techs) == 0:
+        return 'unknown'
+    elif len(techs) > 1:
+        return 'multiple'
+    return techs[0]
+
+
 # to do in priority order
 # TODO done list
 # TODO filter srplist using donelist
 # TODO error handling - fastq dump
-# TODO multithread 10xversion imputation
 # TODO multiple technologies found in LCP for given experiment - currently ignores
 
 def get_default_config():
@@ -97,6 +281,12 @@ class Impute(object):
         self.log = logging.getLogger('impute')
         self.config = config
         self.metadir = os.path.expanduser(self.config.get('impute', 'metadir'))
+        self.store = get_store(self.config, 'impute')
+        # lcp -> tech results, shared across projects and runs. 
+        self.lcpcache = get_lcp_cache(f'{self.metadir}/lcp-techs.txt')
+        # concurrent fastq-dump read length probes, and where their results are kept.
+        self.max_probes = int(self.config.get('impute', 'max_probes'))
+        self.probecache = os.path.expanduser(f"{self.config.get('impute', 'cachedir')}/readlengths")
         # self.cachedir = os.path.expanduser(
         #     self.config.get('impute', 'cachedir'))
         # self.sra_esearch = self.config.get('sra', 'sra_esearch')
@@ -112,22 +302,31 @@ class Impute(object):
             examples    - SRP114926 - contains both 10x and smartseq
                         - SRP122508 - contains just 10xv2. 192 runs, 10 exp, 10 samples
         """
+        outdf = self.impute(projectid)
+        self.write(outdf, projectid)
+        self.log.info(f'completed imputation for proj_id {projectid}')
+        return projectid
+
+    def impute(self, projectid):
+        """
+        Impute tech, 10x version and batch for projectid (or list of projectids) 
+        without touching impute.tsv, so projects can be imputed in parallel. 
+        Returns impute DF with IMPUTE_COLUMNS. 
+        """
         self.log.info(f'handling projectid {projectid}')
+        if isinstance(projectid, str):
+            projectid = [projectid]
         try:
-            # read in experiment file
-            expfile = f'{self.metadir}/experiments.tsv'
-            edf = pd.read_csv(expfile, sep='\t', index_col=0)
+            # read in experiments for project(s) only
+            edf = self.store.read('experiments', proj_id=projectid)
             self.log.debug(f'opened experiments DF OK...')
-            edf = edf[edf.proj_id.isin(projectid)].reset_index(drop=True) # rename pdf -> edf 
             self.log.debug(f'got project-specific df: \n{edf}')
             # impute technology  -  exp_id|tech
             idf = self.impute_tech_from_lcp(edf)    
             self.log.debug(f'got initial imputed tech df: \n{idf}')
 
             # match run to tech
-            runfile = f'{self.metadir}/runs.tsv'
-            rdf = pd.read_csv(runfile, sep='\t', index_col=0)
-            rdf = rdf[rdf.proj_id.isin(projectid)].reset_index(drop=True)
+            rdf = self.store.read('runs', proj_id=projectid)
             # impute 10x version
             outdf = self.impute_10x_version(idf, rdf)
             self.log.debug(f'got imputed 10x version df: \n{outdf}')
@@ -137,9 +336,7 @@ class Impute(object):
             outdf=outdf.append(ssdf)
 
             # append the inferred batch from samples.tsv
-            samplefile = f'{self.metadir}/samples.tsv'
-            sdf = pd.read_csv(samplefile, sep='\t', index_col=0)
-            sdf = sdf[sdf.proj_id.isin(projectid)].reset_index(drop=True)
+            sdf = self.store.read('samples', proj_id=projectid)
 
 
             #impute batch
@@ -149,50 +346,40 @@ class Impute(object):
             # save to disk
             outdf = outdf[['run_id' ,'tech_version','read1','read2','exp_id','samp_id','proj_id', 'taxon','batch']]
             outdf.columns = IMPUTE_COLUMNS  # renames the columns from global 
-            if outdf.shape[0] > 0:
-                merge_write_df(outdf, f'{self.metadir}/impute.tsv')  
-            else :
-                self.log.warn(f'Unable to predict tech for:{projectid} ')
-                
-            self.log.info(f'completed imputation for proj_id {projectid}')
-            return projectid          
+            return outdf
 
         except Exception as ex:
             self.log.error(f'problem with NCBI projectid {projectid}')
             logging.error(traceback.format_exc(None))
             raise ex
 
+    def write(self, outdf, projectid):
+        """
+        Merge imputed DF into impute table. Not thread-safe: call from one writer only. 
+        """
+        if outdf.shape[0] > 0:
+            self.store.merge('impute', outdf)
+        else :
+            self.log.warn(f'Unable to predict tech for:{projectid} ')
+
     # updated 6/29 jlee. 
     # TODO deal with multiple tech finds
     def impute_tech_from_lcp(self,df):
         '''
         Take in experiment df for specific project.  
             Get unique library construction protocol (lcp) values. 
-            For each value, loop over all keyword terms, identifying putative tech. 
+            Look each up in the lcp cache, classifying only values not seen before, identifying putative tech. 
             Fill in method column for all runs in temp DF.   
             Create impute DF
         
         '''
         logging.debug(f'got df: \n{df}')
+        # doesn't play nice with NaN lcp - fill with a str
         df.lcp= df.lcp.fillna('None').values
 
+        # one pass over each unique lcp, previously seen lcps come from the cache
         ulcp = pd.DataFrame({"lcp": df.lcp.unique()})
-        ulcp['tech'] ='unknown'
-        ulcp['techcount'] =0
-        # ulcp= ulcp.loc[1:,:].reset_index(drop=True) 
-        
-        # search for the keywords
-        # doesn't play nice with NaN lcp - fill with a str
-
-        for i in range(len(TECH_RES)):
-            key = list(TECH_RES)[i]
-            kw = TECH_RES[key]
-            ulcp[key] = ulcp.lcp.str.contains(kw)
-        
-            ulcp.loc[ulcp[key],'tech'] = key
-            ulcp.loc[ulcp[key],'techcount'] +=1
-        
-        ulcp.loc[ulcp['techcount'] > 1,'tech'] = 'multiple'
+        ulcp['tech'] = [ classify_techs(t) for t in self.lcpcache.lookup(list(ulcp.lcp)) ]
         dfout = ulcp[['lcp','tech']]
         self.log.debug(f'keyword hits: {ulcp.tech.values}')
         
@@ -205,18 +392,18 @@ class Impute(object):
     # TODO error handling
     def impute_10x_version(self,idf,rdf):
         """
-        For known 10x, get first part of fasta file and determine version.
+        For known 10x, get read lengths and determine version. 
+        Read lengths come from run metadata (efetch Statistics/Read), a per-run cache 
+        in cachedir, or a concurrent fastq-dump probe of the first spot, in that order. 
         Only looks at the 10x portion if multiple techs used.
         Returns only 10x runs
         doesn't matter if multiple projects are included
         """
 
-        # look at the first few lines of the fastq file.
-        loglev = LOGLEVELS[self.log.getEffectiveLevel()]
-        # print( f'\n{loglev}\n')
-        
         # require runs have rdf.nreads > 1. Otherwise, unable to impute
         rdf = rdf [rdf.nreads > 1]
+        # screened runs aren't downloaded or aligned, don't probe them either.
+        rdf = screen_runs(self.config, rdf)
         df = rdf.merge(idf, on = 'exp_id',how='left')
 
         # get all runs associated with the 10x inferred experiments
@@ -225,53 +412,34 @@ class Impute(object):
             print('no runs imputable') 
             return pd.DataFrame(columns=['run_id' ,'tech_version','read1','read2','exp_id','proj_id', 'taxon'])
 
+        # read lengths from query metadata where we have them, probe the rest.
+        if 'read_lengths' in df.columns:
+            metalens = dict(zip(df.run_id, df.read_lengths))
+        else:
+            metalens = {}
+        lengths = {}
+        toprobe = []
+        for srrid in runs:
+            l = self._parse_lengths(metalens.get(srrid))
+            if l is None:
+                l = self._read_cache(srrid)
+            if l is None:
+                toprobe.append(srrid)
+            else:
+                lengths[srrid] = l
+        self.log.debug(f'{len(lengths)} runs with known read lengths, probing {len(toprobe)}')
+
+        with ThreadPoolExecutor(max_workers=self.max_probes) as pool:
+            for (srrid, l) in zip(toprobe, pool.map(self._probe_read_lengths, toprobe)):
+                if l is not None:
+                    lengths[srrid] = l
+
         allRows = []
-        # TODO multithread?
-        for srrid in runs :
-
-            cmd = ['fastq-dump',
-                '--maxSpotId', '1',
-                '--split-spot',
-                '--stdout',
-                '--log-level', f'{loglev}',
-                srrid]      # don't assume that sra file exists. most likely wont
-
-            # TODO suppress messages from cmd
-            cp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            dat = cp.stdout.read().decode("utf-8").split('\n')[:-1]
-
-            # get the lengths of each read.
-            lengths = {}
-            it = 1
-            for line in dat[0::4]:  # look at every 4 lines for the length of the read
-                lengths[f'{srrid}_{it}.fastq'] = line.split("length=")[-1]
-                it += 1
-
-            l = [int(l) for l in lengths.values()]
-            ind = l.index(max(l))
-
-            # which is the longest? use as cDNA read
-            read_bio = list(lengths.keys())[ind]
-            
-            # 10xv2 is typically 98 bp
-            # 10xv3 is typically 91 bp
-            tech = "10x"
-            for i in range(len(lengths)):
-                if l[i] == 24:
-                    tech = "10xv1"
-                    ind2 = i
-                elif l[i] == 26:
-                    ind2 = i
-                    tech = "10xv2"
-                elif l[i] == 28:
-                    ind2 = i
-                    tech = "10xv3"
-
-            if tech == "10x":
-                read_tech = None
+        for srrid in runs:
+            if srrid in lengths:
+                allRows.append(self._tech_from_lengths(srrid, lengths[srrid]))
             else:
-                read_tech = list(lengths.keys())[ind2]
-            allRows.append([srrid, tech, read_bio, read_tech])
+                self.log.warning(f'no read lengths for {srrid}. skipping.')
 
         outdf = pd.DataFrame(allRows,columns=['run_id','tech_version','read1','read2'] )
         tax = rdf[['run_id','samp_id','exp_id','proj_id','taxon']]
@@ -282,6 +450,89 @@ class Impute(object):
         return outdf[['run_id' ,'tech_version','read1','read2','exp_id','samp_id','proj_id', 'taxon']]
 
 
+    def _parse_lengths(self, val):
+        '''
+        read_lengths column value, e.g. "[26, 98]", to list of ints. None if unusable. 
+        '''
+        try:
+            l = [int(x) for x in ast.literal_eval(val)]
+        except (ValueError, SyntaxError, TypeError):
+            return None
+        if len(l) == 0 or max(l) == 0:
+            return None
+        return l
+
+    def _read_cache(self, srrid):
+        try:
+            with open(f'{self.probecache}/{srrid}.lengths') as f:
+                return self._parse_lengths(f.read())
+        except OSError:
+            return None
+
+    def _write_cache(self, srrid, l):
+        try:
+            os.makedirs(self.probecache, exist_ok=True)
+            with open(f'{self.probecache}/{srrid}.lengths', 'w') as f:
+                f.write(str(l))
+        except OSError:
+            self.log.warning(f'unable to cache read lengths for {srrid}')
+
+    def _probe_read_lengths(self, srrid):
+        '''
+        Read lengths of first spot of srrid via fastq-dump. Caches result on disk. 
+        '''
+        loglev = LOGLEVELS[self.log.getEffectiveLevel()]
+        cmd = ['fastq-dump',
+            '--maxSpotId', '1',
+            '--split-spot',
+            '--stdout',
+            '--log-level', f'{loglev}',
+            srrid]      # don't assume that sra file exists. most likely wont
+
+        cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        dat = cp.stdout.decode("utf-8").split('\n')[:-1]
+        # get the lengths of each read.
+        # look at every 4 lines for the length of the read
+        try:
+            l = [int(line.split("length=")[-1]) for line in dat[0::4]]
+        except ValueError:
+            l = []
+        if len(l) == 0:
+            self.log.warning(f'fastq-dump probe failed for {srrid} returncode={cp.returncode}')
+            return None
+        self._write_cache(srrid, l)
+        return l
+
+    def _tech_from_lengths(self, srrid, l):
+        '''
+        Infer 10x version and bio/tech read files from per-read lengths. 
+        '''
+        lengths = [f'{srrid}_{i + 1}.fastq' for i in range(len(l))]
+        ind = l.index(max(l))
+
+        # which is the longest? use as cDNA read
+        read_bio = lengths[ind]
+        
+        # 10xv2 is typically 98 bp
+        # 10xv3 is typically 91 bp
+        tech = "10x"
+        for i in range(len(lengths)):
+            if l[i] == 24:
+                tech = "10xv1"
+                ind2 = i
+            elif l[i] == 26:
+                ind2 = i
+                tech = "10xv2"
+            elif l[i] == 28:
+                ind2 = i
+                tech = "10xv3"
+
+        if tech == "10x":
+            read_tech = None
+        else:
+            read_tech = lengths[ind2]
+        return [srrid, tech, read_bio, read_tech]
+
     def parse_smartseq(self,idf,rdf):
         """
         For known smartseq, parse, build manifest
@@ -294,8 +545,10 @@ class Impute(object):
 
         # get all runs associated with the smartseq inferred experiments
         df = rdf.merge(idf , on="exp_id", how = 'inner')    
-        df = df[['run_id','taxon','nreads','exp_id','tech']]
-        runs = df.loc[ df.tech == 'smartseq','run_id']
+        df = df[['run_id','taxon','nreads','tot_spots','size','exp_id','tech']]
+        # per-cell runs: leave out (nearly) empty ones before they are downloaded 
+        df = screen_runs(self.config, df[df.tech == 'smartseq'])
+        runs = df.run_id
         
         outdf=pd.DataFrame({'run_id' : runs ,'tech_version':'smartseq'})
 
@@ -317,62 +570,78 @@ class Impute(object):
         Uses the sample data to infer batch. If no batches are found, (i.e. everything 
         gets assigned batch 0), use cell/runs > as batch predictor during `gatherstats.py`
 
-        This should only be run at the project level dataframes, but just in case,
-        Splits by project id first and assigns a set batches to each 
-        project id 
+        Handles any number of projects in one pass. Batches are assigned per project id:
+            sample id, if it splits the project's runs (>1 value, fewer values than runs)
+            else sample attributes, if they do
+            else experiment id (or run id) at the run level, if it does 
+            else 0
+        Returns run_id, batch
         '''
-        
-        cols = rdf.columns.tolist()
-        cols.append('batch')
-        new_rdf = pd.DataFrame(columns=cols )
-        for proj , df in sdf.groupby('proj_id') :
-            
-            tm_rdf = rdf.loc[ rdf.proj_id == proj ,:] 
-            
-            # factorize outputs a tuple (index, attribute)
-            samp2batch = pd.DataFrame({ 'samp_id' : df['samp_id'],
-                            'samp' : pd.factorize(df.samp_id)[0] ,
-                            'attr': pd.factorize(df['attributes'])[0],
-                            'exp_id': pd.factorize(df['samp_id'])[0]})
-            self.log.debug(f'sample to batch \n{samp2batch}')
-            # batches should  contain at least two runs
-            counts1 = samp2batch.iloc[:,1:].apply( lambda x: len(x.unique()) ,axis=0) > 1
-            # batches shouldn't include all cells
-            counts2 = samp2batch.iloc[:,1:].apply( lambda x: len(x.unique()) ,axis=0) < tm_rdf.shape[0]
-
-            batch = list(counts1 &counts2)    # which columns denote possible batches
-            # indicates that the 'samp_id' shouldn't be used for batch- only for merge
-            batch.insert(0,False)   
-            # batch not found at the sample level. Look at other levels.
-            # samples are either unique per run or there is only one sample
-            
-
-            if sum(batch) == 0 :
-                run2batch = pd.DataFrame({ 'run_id' : pd.factorize(tm_rdf['run_id'])[0] ,    
-                            'exp_id': pd.factorize(tm_rdf['exp_id'])[0]})
-                counts1 = run2batch.apply( lambda x: len(x.unique()) ,axis=0) > 1
-                # batches shouldn't include all cells
-                counts2 = run2batch.apply( lambda x: len(x.unique()) ,axis=0) < tm_rdf.shape[0]
-                batch = counts1 &counts2    # which columns denote possible batches
-                
-                # batch is still False for everything. No batch inferred. 
-                # If no batch inferred, need to align, get number of cells/run.
-                # if ncells/run > 1 -> assign runs as the batch (e.g. 10x samples)
-
-                if batch.sum() == 0:
-                    samp2batch['batch'] = 0 # everything gets the same batch id
-                else:
-                    samp2batch['batch'] = run2batch.loc[:,batch].iloc[:,-1]
-            else :
-                    samp2batch['batch'] = samp2batch.loc[:,batch].iloc[:,-1]
-
-            # merge these batches with the runs 
-            tm_rdf=tm_rdf.merge(samp2batch[['samp_id','batch']], how ="left", on="samp_id")
-
-            new_rdf = pd.concat([new_rdf, tm_rdf])
-
+        sdf = sdf[sdf.proj_id.notna()]
+        rdf = rdf[rdf.proj_id.isin(sdf.proj_id.unique())]
+        nruns = rdf.groupby('proj_id').size()
+        nruns = sdf.proj_id.map(nruns).fillna(0).values
+
+        # per-project factorize codes. NaN attributes get -1, like pd.factorize
+        samp = self._group_codes(sdf, 'samp_id')
+        attr = self._group_codes(sdf, 'attributes')
+        # batches should contain at least two runs, and shouldn't include all cells
+        samp_n = samp.groupby(sdf.proj_id.values).transform('nunique').values
+        attr_n = attr.groupby(sdf.proj_id.values).transform('nunique').values
+        samp_ok = (samp_n > 1) & (samp_n < nruns)
+        attr_ok = (attr_n > 1) & (attr_n < nruns)
+
+        batch = pd.Series(np.where(samp_ok, samp.values, attr.values), index=sdf.index, dtype=float)
+
+        # batch not found at the sample level. Look at the run level.
+        # run level codes are picked by the sample's index label as position within 
+        # the project's runs, as the per-project version did when assigning across frames.
+        fallback = ~(samp_ok | attr_ok)
+        if fallback.any():
+            run = self._group_codes(rdf, 'run_id')
+            exp = self._group_codes(rdf, 'exp_id')
+            rproj = rdf.proj_id.values
+            run_n = run.groupby(rproj).transform('nunique').values
+            exp_n = exp.groupby(rproj).transform('nunique').values
+            rnruns = rdf.groupby('proj_id').proj_id.transform('size').values
+            run_ok = (run_n > 1) & (run_n < rnruns)
+            exp_ok = (exp_n > 1) & (exp_n < rnruns)
+            rdf_batch = pd.DataFrame({'proj_id': rproj,
+                                      'pos': rdf.groupby('proj_id').cumcount().values,
+                                      'rbatch': np.where(exp_ok, exp.values, run.values),
+                                      'rfound': run_ok | exp_ok })
+
+            # project-level: any run level batch found? If not everything gets batch 0
+            found = rdf_batch.groupby('proj_id').rfound.any()
+            sfound = sdf.proj_id.map(found).fillna(False).values.astype(bool)
+            pos = pd.DataFrame({'proj_id': sdf.proj_id.values, 'pos': sdf.index.values})
+            pos = pos.merge(rdf_batch[['proj_id','pos','rbatch']], on=['proj_id','pos'], how='left')
+            rbatch = np.where(sfound, pos.rbatch.values, 0)
+            batch[fallback] = rbatch[fallback]
+
+        samp2batch = pd.DataFrame({'proj_id': sdf.proj_id.values,
+                                   'samp_id': sdf.samp_id.values,
+                                   'batch': batch.values })
+        self.log.debug(f'sample to batch \n{samp2batch}')
+
+        # merge these batches with the runs, in project order 
+        new_rdf = rdf.merge(samp2batch, how="left", on=['proj_id','samp_id'])
+        new_rdf = new_rdf.sort_values('proj_id', kind='stable')
+        if new_rdf.batch.notna().all():
+            new_rdf['batch'] = new_rdf.batch.astype(int)
         return new_rdf[['run_id','batch']]
 
+    def _group_codes(self, df, col):
+        '''
+        pd.factorize codes of df[col] within each proj_id, NaN -> -1. 
+        Groups are numbered in order of first appearance, so ranking them within 
+        each project gives the same codes as factorizing each project separately.
+        '''
+        codes = df.groupby(['proj_id', col], sort=False).ngroup()
+        codes = codes.groupby(df.proj_id.values).rank(method='dense') - 1
+        codes[df[col].isna().values] = -1
+        return codes.astype(int)
+
 
 if __name__ =="__main__":
 
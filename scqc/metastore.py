@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+#
+#  Storage for project/sample/experiment/run/impute metadata tables.
+#
+#  Two backends behind the same merge()/read() API, chosen by 'metastore' in config:
+#    tsv     one <metadir>/<table>.tsv per table. Every merge re-reads and rewrites the
+#            whole file (original behavior, O(total rows) per project).
+#    sqlite  one <metadir>/metadata.db. Upsert on each table's primary key, indexed
+#            on proj_id, so a merge or read only touches that project's rows.
+#
+#  Existing TSVs are imported into sqlite the first time a table is used.
+#
+#  Both backends answer per-project reads and id -> proj_id lookups from an index
+#  in O(project size), not O(whole table):
+#    tsv     memory-mapped sidecar index per table (TSVIndex), rebuilt when the TSV
+#            changes (size, mtime, inode).
+#    sqlite  primary key and proj_id b-tree indices, database file memory-mapped.
+#
+
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+
+from scqc.utils import merge_write_df, lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# table -> primary key. all tables also carry proj_id.
+TABLE_KEYS = {
+    'projects': 'proj_id',
+    'samples': 'samp_id',
+    'experiments': 'exp_id',
+    'runs': 'run_id',
+    'impute': 'run_id',
+}
+
+# columns that are always numbers (NaN if missing or unparseable), whatever a batch held.
+NUMERIC_COLUMNS = {
+    'samples': ['taxon'],
+    'runs': ['tot_spots', 'tot_bases', 'size', 'taxon', 'nreads'],
+}
+
+# bytes of sqlite db to memory-map per connection.
+MMAP_SIZE = 1024 * 1024 * 1024
+
+
+def register_adapters():
+    # sqlite3 doesn't know numpy scalars. here, not at import, so numpy stays lazy.
+    sqlite3.register_adapter(np.int64, int)
+    sqlite3.register_adapter(np.int32, int)
+    sqlite3.register_adapter(np.bool_, bool)
+
+
+def get_store(config, section):
+    '''
+    Build store for metadir of config <section>.
+    '''
+    metadir = os.path.expanduser(config.get(section, 'metadir'))
+    backend = config.get(section, 'metastore').lower().strip()
+    if backend == 'sqlite':
+        return SQLiteStore(metadir)
+    elif backend == 'tsv':
+        return TSVStore(metadir)
+    else:
+        raise ValueError(f'unknown metastore backend: {backend}')
+
+
+def _as_list(proj_id):
+    if isinstance(proj_id, str):
+        return [proj_id]
+    return list(proj_id)
+
+
+class TSVIndex(object):
+    '''
+    Sidecar index for a TSV written by merge_write_df. Three files next to the TSV:
+        <tsv>.idx.json   stamp (size, mtime_ns, inode) of the TSV the index was built from
+        <tsv>.proj.npy   (proj_id, start, end) byte range per record, sorted by proj_id
+        <tsv>.key.npy    (key, proj_id) per record, sorted by key
+
+    The .npy files are opened memory-mapped and searched with np.searchsorted.
+    If the TSV's stamp has changed the index is rebuilt by one scan of the file.
+    '''
+
+    def __init__(self, tsvfile, key):
+        self.log = logging.getLogger('metastore')
+        self.tsvfile = tsvfile
+        self.key = key
+        self.stampfile = f'{tsvfile}.idx.json'
+        self.projfile = f'{tsvfile}.proj.npy'
+        self.keyfile = f'{tsvfile}.key.npy'
+        self.stamp = None
+        self.projidx = None
+        self.keyidx = None
+
+    def _tsvstamp(self):
+        st = os.stat(self.tsvfile)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def _records(self, f):
+        '''
+        Yield (start, end) byte offsets of each record after the header.
+        Quoted fields may span lines, so a record ends at a newline with even quote count.
+        '''
+        offset = f.tell()
+        start = offset
+        quotes = 0
+        for line in f:
+            quotes += line.count(b'"')
+            offset += len(line)
+            if quotes % 2 == 0:
+                yield (start, offset)
+                start = offset
+                quotes = 0
+
+    def _save(self, path, arr):
+        rootpath = os.path.dirname(path)
+        (tfd, tfname) = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", dir=f"{rootpath}/")
+        with os.fdopen(tfd, 'wb') as f:
+            np.save(f, arr)
+        os.rename(tfname, path)
+
+    def build(self):
+        self.log.info(f'building index for {self.tsvfile}')
+        stamp = self._tsvstamp()
+        projs = []
+        keys = []
+        ranges = []
+        with open(self.tsvfile, 'rb') as f:
+            header = next(csv.reader([f.readline().decode()], delimiter='\t'))
+            pcol = header.index('proj_id')
+            kcol = header.index(self.key)
+            for (start, end) in self._records(f):
+                f.seek(start)
+                rec = f.read(end - start).decode()
+                fields = next(csv.reader(io.StringIO(rec), delimiter='\t'))
+                projs.append(fields[pcol])
+                keys.append(fields[kcol])
+                ranges.append((start, end))
+                f.seek(end)
+
+        plen = max([len(p) for p in projs] + [1])
+        klen = max([len(k) for k in keys] + [1])
+        projidx = np.array([(p, s, e) for (p, (s, e)) in zip(projs, ranges)],
+                           dtype=[('proj', f'S{plen}'), ('start', 'i8'), ('end', 'i8')])
+        projidx.sort(order=['proj', 'start'], kind='stable')
+        keyidx = np.array(list(zip(keys, projs)),
+                          dtype=[('key', f'S{klen}'), ('proj', f'S{plen}')])
+        keyidx.sort(order='key', kind='stable')
+
+        self._save(self.projfile, projidx)
+        self._save(self.keyfile, keyidx)
+        with open(self.stampfile, 'w') as f:
+            json.dump(stamp, f)
+        self.log.debug(f'indexed {len(projs)} records of {self.tsvfile}')
+
+    def load(self):
+        '''
+        Open (rebuilding if stale) the memory-mapped index. Cheap if already current.
+        '''
+        stamp = self._tsvstamp()
+        if self.stamp == stamp:
+            return
+        try:
+            with open(self.stampfile) as f:
+                ondisk = json.load(f)
+        except (OSError, ValueError):
+            ondisk = None
+        if ondisk != stamp:
+            self.build()
+        self.projidx = np.load(self.projfile, mmap_mode='r')
+        self.keyidx = np.load(self.keyfile, mmap_mode='r')
+        self.stamp = stamp
+
+    def _encode(self, vals, arr, field):
+        width = arr.dtype[field].itemsize
+        return np.array([str(v).encode()[:width + 1] for v in vals], dtype=f'S{width + 1}')
+
+    def ranges(self, proj_ids):
+        '''
+        Byte ranges of records for proj_ids, in file order.
+        '''
+        self.load()
+        out = []
+        pidx = self.projidx['proj']
+        for p in self._encode(proj_ids, self.projidx, 'proj'):
+            lo = np.searchsorted(pidx, p, side='left')
+            hi = np.searchsorted(pidx, p, side='right')
+            out.extend(zip(self.projidx['start'][lo:hi], self.projidx['end'][lo:hi]))
+        out.sort()
+        return out
+
+    def projects(self, keys):
+        '''
+        Dict key -> proj_id for keys found in the table.
+        '''
+        self.load()
+        out = {}
+        kidx = self.keyidx['key']
+        for (k, ek) in zip(keys, self._encode(keys, self.keyidx, 'key')):
+            i = np.searchsorted(kidx, ek, side='left')
+            if i < len(kidx) and kidx[i] == ek:
+                out[k] = self.keyidx['proj'][i].decode()
+        return out
+
+    def read(self, proj_ids):
+        '''
+        DataFrame of just the records for proj_ids, read by seeking to their byte ranges.
+        '''
+        ranges = self.ranges(proj_ids)
+        with open(self.tsvfile, 'rb') as f:
+            chunks = [f.readline()]
+            for (start, end) in ranges:
+                f.seek(start)
+                chunks.append(f.read(end - start))
+        return pd.read_csv(io.BytesIO(b''.join(chunks)), sep='\t', index_col=0, comment="#")
+
+
+class TSVStore(object):
+    '''
+    Flat TSV per table, full rewrite via merge_write_df.
+    Per-project reads and id lookups go through a TSVIndex.
+    '''
+
+    def __init__(self, metadir):
+        self.log = logging.getLogger('metastore')
+        self.metadir = metadir
+        self.indices = {}
+
+    def _index(self, table):
+        if table not in self.indices:
+            self.indices[table] = TSVIndex(f'{self.metadir}/{table}.tsv', TABLE_KEYS[table])
+        return self.indices[table]
+
+    def merge(self, table, df):
+        # rename gives the TSV a new inode, which invalidates the index.
+        merge_write_df(df, f'{self.metadir}/{table}.tsv')
+
+    def read(self, table, proj_id=None):
+        if proj_id is not None:
+            return self._index(table).read(_as_list(proj_id)).reset_index(drop=True)
+        return pd.read_csv(f'{self.metadir}/{table}.tsv', sep='\t', index_col=0, comment="#")
+
+    def projects(self, table, ids):
+        '''
+        Dict of primary key id -> proj_id, e.g. projects('runs', ['SRR123']).
+        '''
+        return self._index(table).projects(list(ids))
+
+
+class SQLiteStore(object):
+    '''
+    SQLite store. Rows are upserted on TABLE_KEYS primary key, reads can be limited
+    to a list of proj_ids via an index.
+
+    Columns are created as needed from the inbound DataFrame, without declared type, so
+    values keep the type they were written with. NUMERIC_COLUMNS are converted on write.
+    Other columns are typed on read across the whole result, as pd.read_csv() does for
+    the TSVs: numeric if every value is, otherwise strings. So one column never comes
+    back with numbers in some rows and strings in others.
+    '''
+
+    def __init__(self, metadir):
+        self.log = logging.getLogger('metastore')
+        self.metadir = metadir
+        self.dbfile = f'{metadir}/metadata.db'
+        register_adapters()
+
+    def _connect(self):
+        # long timeout: several stage daemons may write at once.
+        con = sqlite3.connect(self.dbfile, timeout=600)
+        con.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        return con
+
+    def _columns(self, con, table):
+        return [row[1] for row in con.execute(f'PRAGMA table_info("{table}")')]
+
+    def _ensure_table(self, con, table, columns):
+        '''
+        Create table/indices if needed, add any new columns. Returns table columns.
+        '''
+        key = TABLE_KEYS[table]
+        existing = self._columns(con, table)
+        if len(existing) == 0:
+            cols = [key] + [c for c in columns if c != key]
+            coldefs = ', '.join(
+                [f'"{c}" PRIMARY KEY' if c == key else f'"{c}"' for c in cols])
+            con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({coldefs})')
+            if key != 'proj_id':
+                con.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{table}_proj_id" ON "{table}" ("proj_id")')
+            existing = self._columns(con, table)
+            self.log.debug(f'created table {table} columns={existing}')
+        for c in columns:
+            if c not in existing:
+                con.execute(f'ALTER TABLE "{table}" ADD COLUMN "{c}"')
+                existing.append(c)
+        return existing
+
+    def _import_tsv(self, con, table):
+        '''
+        One-time import of legacy <table>.tsv, if table doesn't exist yet.
+        '''
+        tsvfile = f'{self.metadir}/{table}.tsv'
+        if len(self._columns(con, table)) == 0 and os.path.isfile(tsvfile):
+            self.log.info(f'importing {tsvfile} into {self.dbfile}')
+            df = pd.read_csv(tsvfile, sep='\t', index_col=0, comment="#")
+            self._upsert(con, table, df)
+
+    def _coerce(self, table, df):
+        '''
+        NUMERIC_COLUMNS of table to numbers. Anything unparseable becomes NaN.
+        '''
+        df = df.copy()
+        for c in NUMERIC_COLUMNS.get(table, []):
+            if c in df.columns:
+                df[c] = pd.to_numeric(df[c], errors='coerce')
+        return df
+
+    def _infer(self, table, df):
+        '''
+        Type each column of a read result as a whole: NUMERIC_COLUMNS as numbers,
+        others numeric if all values are, else strings.
+        '''
+        df = self._coerce(table, df)
+        for c in df.columns:
+            if pd.api.types.is_numeric_dtype(df[c]):
+                continue
+            try:
+                df[c] = pd.to_numeric(df[c])
+            except (ValueError, TypeError):
+                df[c] = df[c].map(lambda v: None if pd.isna(v) else str(v))
+        return df
+
+    def _upsert(self, con, table, df):
+        key = TABLE_KEYS[table]
+        df = self._coerce(table, df)
+        df = df.drop_duplicates(subset=[key], keep='last')
+        self._ensure_table(con, table, list(df.columns))
+        cols = ', '.join([f'"{c}"' for c in df.columns])
+        qs = ', '.join(['?'] * len(df.columns))
+        rows = df.astype(object).where(pd.notnull(df), None).values.tolist()
+        con.executemany(
+            f'INSERT OR REPLACE INTO "{table}" ({cols}) VALUES ({qs})', rows)
+        self.log.debug(f'upserted {len(rows)} rows into {table}')
+
+    def merge(self, table, df):
+        '''
+        Upsert df rows into table, replacing rows with the same primary key.
+        '''
+        with self._connect() as con:
+            self._import_tsv(con, table)
+            self._upsert(con, table, df)
+        con.close()
+        self.log.info(f'merged {len(df)} rows into {table}')
+
+    def read(self, table, proj_id=None):
+        '''
+        Read table, optionally only rows for proj_id (str or list).
+        '''
+        with self._connect() as con:
+            self._import_tsv(con, table)
+            sql = f'SELECT * FROM "{table}"'
+            params = []
+            if proj_id is not None:
+                params = _as_list(proj_id)
+                qs = ', '.join(['?'] * len(params))
+                sql += f' WHERE "proj_id" IN ({qs})'
+            df = pd.read_sql_query(sql, con, params=params)
+        con.close()
+        return self._infer(table, df)
+
+    def projects(self, table, ids):
+        '''
+        Dict of primary key id -> proj_id, e.g. projects('runs', ['SRR123']).
+        '''
+        key = TABLE_KEYS[table]
+        ids = list(ids)
+        out = {}
+        with self._connect() as con:
+            self._import_tsv(con, table)
+            # stay under sqlite's bound-variable limit.
+            for i in range(0, len(ids), 900):
+                chunk = ids[i:i + 900]
+                qs = ', '.join(['?'] * len(chunk))
+                sql = f'SELECT "{key}", "proj_id" FROM "{table}" WHERE "{key}" IN ({qs})'
+                for (k, p) in con.execute(sql, chunk):
+                    out[k] = p
+        con.close()
+        return out
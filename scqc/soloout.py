@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+#  Readers for STARsolo Solo.out directories.
+#
+#  Matrices are parsed with scipy's MatrixMarket reader (multithreaded C++ since
+#  scipy 1.12) and go straight from coordinates to cell x gene CSR. Barcodes, features
+#  and stats files are plain line splits. SoloOut loads one Solo.out concurrently,
+#  the (large) raw matrix only if asked for. geneInfo.tab is parsed once per STAR
+#  index and process.
+#
+
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.io import mmread
+
+GENEINFO_COLUMNS = ['gene_accession', 'gene_symbol', 'type']
+FEATURE_COLUMNS = ['gene_accession', 'gene_symbol', 'source']
+
+
+def read_mtx(path):
+    '''
+    STAR matrix.mtx (gene x cell) as cell x gene CSR, float32 like scanpy.
+    '''
+    coo = sparse.coo_matrix(mmread(path))
+    # transposing coordinates is free, CSR conversion sums any duplicates.
+    return sparse.csr_matrix((coo.data.astype(np.float32), (coo.col, coo.row)),
+                             shape=(coo.shape[1], coo.shape[0]))
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [line.rstrip('\n').split('\t') for line in f if len(line.strip()) > 0]
+
+
+def read_stats(path, sep=None):
+    '''
+    Two-column stat/value file. Barcodes.stats and Features.stats are whitespace
+    separated, Summary.csv comma separated.
+    '''
+    rows = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().rsplit(sep, 1)
+            if len(fields) == 2:
+                rows.append([fields[0].strip(), fields[1].strip()])
+    return pd.DataFrame(rows, columns=['stat', 'value'])
+
+
+_geneinfo = {}
+_geneinfo_lock = threading.Lock()
+
+
+def read_gene_info(starindexdir):
+    '''
+    geneInfo.tab of a STAR index (first line is the count). Cached per index,
+    re-read if the file changes.
+    '''
+    path = f'{starindexdir}/geneInfo.tab'
+    mtime = os.path.getmtime(path)
+    with _geneinfo_lock:
+        cached = _geneinfo.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    rows = read_lines(path)[1:]
+    df = pd.DataFrame(rows, columns=GENEINFO_COLUMNS, dtype=str)
+    with _geneinfo_lock:
+        _geneinfo[path] = (mtime, df)
+    return df
+
+
+class SoloMatrix(object):
+    '''
+    One Solo.out matrix directory (e.g. Gene/raw): X is cell x gene CSR, barcodes a list,
+    features a DF with FEATURE_COLUMNS.
+    '''
+
+    def __init__(self, X, barcodes, features):
+        self.X = X
+        self.barcodes = barcodes
+        self.features = features
+
+
+class SoloOut(object):
+    '''
+    Everything in one Solo.out for a feature type, loaded concurrently:
+        raw, filtered           SoloMatrix (None if the directory is missing).
+                                raw is only read if raw=True, otherwise None.
+        barcode_stats           Barcodes.stats
+        feature_stats           <feature>/Features.stats
+        summary                 <feature>/Summary.csv
+        geneinfo                geneInfo.tab of starindexdir, if given
+
+    '''
+
+    def __init__(self, solooutdir, starindexdir=None, feature='Gene', nthreads=4, raw=False):
+        self.log = logging.getLogger('soloout')
+        self.solooutdir = solooutdir
+        self.feature = feature
+        fdir = f'{solooutdir}/{feature}'
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            rawmatrix = None
+            if raw:
+                rawmatrix = pool.submit(self._read_matrix, f'{fdir}/raw')
+            filtered = pool.submit(self._read_matrix, f'{fdir}/filtered')
+            barcode_stats = pool.submit(read_stats, f'{solooutdir}/Barcodes.stats')
+            feature_stats = pool.submit(read_stats, f'{fdir}/Features.stats')
+            summary = pool.submit(read_stats, f'{fdir}/Summary.csv', ',')
+            geneinfo = None
+            if starindexdir is not None:
+                geneinfo = pool.submit(read_gene_info, starindexdir)
+            self.raw = None if rawmatrix is None else rawmatrix.result()
+            self.filtered = filtered.result()
+            self.barcode_stats = barcode_stats.result()
+            self.feature_stats = feature_stats.result()
+            self.summary = summary.result()
+            self.geneinfo = None if geneinfo is None else geneinfo.result()
+
+    def _read_matrix(self, mdir):
+        if not os.path.isdir(mdir):
+            self.log.debug(f'no matrix in {mdir}')
+            return None
+        X = read_mtx(f'{mdir}/matrix.mtx')
+        barcodes = [row[0] for row in read_lines(f'{mdir}/barcodes.tsv')]
+        features = pd.DataFrame([row[:3] for row in read_lines(f'{mdir}/features.tsv')],
+                                columns=FEATURE_COLUMNS, dtype=str)
+        return SoloMatrix(X, barcodes, features)
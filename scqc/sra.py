@@ -15,9 +15,12 @@ import logging
 import os
 import re
 import requests
+import shutil
 import subprocess
 import sys
 import time
+import urllib.parse
+import urllib3
 
 from pathlib import Path
 from configparser import ConfigParser
@@ -26,13 +29,18 @@ from queue import Queue, Empty
 from requests.exceptions import ChunkedEncodingError
 
 import xml.etree.ElementTree as et
-import pandas as pd
-import numpy as np
 
 gitpath = os.path.expanduser("~/git/scqc")
 sys.path.append(gitpath)
 
 from scqc.utils import *
+# heavy, imported on first use
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+from scqc.eutils import get_client
+from scqc.download import RangeDownloader, MB
+from scqc.cache import get_cache
+from scqc.metastore import get_store
 
 # Translate between Python and SRAToolkit log levels for wrapped commands.
 #  fatal|sys|int|err|warn|info|debug
@@ -44,6 +52,9 @@ LOGLEVELS = {
     50: 'fatal',
 }
 
+# runinfo CSV endpoint, overridden by [sra] sra_runinfo.
+SRA_RUNINFO = 'https://trace.ncbi.nlm.nih.gov/Traces/sra/sra.cgi'
+
 PROJ_COLUMNS = ['proj_id', 'ext_ids', 'title', 'abstract', 'submission_id']
 
 SAMP_COLUMNS = ['samp_id', 'ext_ids',  'taxon',
@@ -53,7 +64,7 @@ EXP_COLUMNS = ['exp_id', 'ext_ids',  'strategy',
                'source', 'lcp', 'samp_id', 'proj_id', 'submission_id']
 
 RUN_COLUMNS = ['run_id', 'ext_ids', 'tot_spots', 'tot_bases', 'size', 'publish_date',
-               'taxon', 'organism', 'nreads',  'basecounts', 'exp_id', 'samp_id', 'proj_id', 'submission_id']
+               'taxon', 'organism', 'nreads',  'basecounts', 'read_lengths', 'exp_id', 'samp_id', 'proj_id', 'submission_id']
 
 IMPUTE_COLUMNS = ['proj_id','exp_id','samp_id','run_id', 'tech']
 
@@ -117,6 +128,18 @@ def get_configstr(cp):
         return ss.read()
 
 
+def sra_path(cachedir, runid):
+    '''
+    Where run's .sra is in cachedir: <cachedir>/<runid>.sra from the native download,
+    or <cachedir>/<runid>/<runid>.sra as prefetch leaves it. The first if neither exists.
+    '''
+    paths = [f'{cachedir}/{runid}.sra', f'{cachedir}/{runid}/{runid}.sra']
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    return paths[0]
+
+
 class RunUnavailableException(Exception):
     """ Thrown when Run in a Runset is unavailable.  """
 
@@ -139,10 +162,15 @@ class Worker(Thread):
         while True:
             try:
                 job = self.q.get_nowait()
-                job.execute()
-                self.q.task_done()
             except Empty:
                 return
+            try:
+                job.execute()
+            except Exception:
+                # don't leave the queue waiting on a dead worker. 
+                logging.error(traceback.format_exc(None))
+            finally:
+                self.q.task_done()
 
 
 # john lee is satisfied with this class 6/3/2021
@@ -207,7 +235,9 @@ class Query(object):
         self.search_term = self.config.get('sra', 'search_term')
         self.query_max = self.config.get('sra', 'query_max')
         # self.uidfile = os.path.expanduser(self.config.get('sra', 'uidfile'))
-        self.query_sleep = float(self.config.get('sra', 'query_sleep'))
+        self.client = get_client(self.config)
+        self.store = get_store(self.config, 'query')
+        self.exp_batchsize = int(self.config.get('sra', 'exp_batchsize'))
 
     def execute(self, projectid):
         """
@@ -216,10 +246,23 @@ class Query(object):
             Put project and run info in project_metadata.tsv and project_runs.tsv
             Put completed project ids into query-donelist.txt
 
+        """
+        dfs = self.query(projectid)
+        self.write(dfs)
+        self.log.info(f'successfully processed project {projectid}')
+        # return projectid only if it has completed successfully.
+        return projectid
+
+    def query(self, projectid):
+        """
+        Fetch and parse all metadata for projectid without touching metadata files, 
+        so many projects can be queried concurrently and written by one writer. 
+        Returns (pdf, sdf, edf, rdf) dataframes. 
+
         """
         self.log.info(f'handling projectid {projectid}')
         try:
-            pdf = query_project_metadata(projectid)
+            pdf = query_project_metadata(projectid, self.config)
             #self.log.debug(f'info: {pdf}')
             #
 
@@ -230,15 +273,16 @@ class Query(object):
             samp_rows = []
             exp_rows = []
             run_rows = []
-            ##  BATCH THIS... XXX
-            for exp in explist:
-                exd = self.query_experiment_package_set(exp)
-                (projrows, samprows, exprows,
-                 runs) = self.parse_experiment_package_set(exd)
-                proj_rows = itertools.chain(proj_rows, projrows)
-                samp_rows = itertools.chain(samp_rows, samprows)
-                exp_rows = itertools.chain(exp_rows, exprows)
-                run_rows = itertools.chain(run_rows, runs)
+            curid = 0
+            while curid < len(explist):
+                batch = explist[curid:curid + self.exp_batchsize]
+                for (projrows, samprows, exprows,
+                     runs) in self.query_experiment_package_batch(batch):
+                    proj_rows = itertools.chain(proj_rows, projrows)
+                    samp_rows = itertools.chain(samp_rows, samprows)
+                    exp_rows = itertools.chain(exp_rows, exprows)
+                    run_rows = itertools.chain(run_rows, runs)
+                curid += self.exp_batchsize
             proj_rows = list(proj_rows)
             samp_rows = list(samp_rows)
             exp_rows = list(exp_rows)
@@ -254,22 +298,25 @@ class Query(object):
             sdf = pd.DataFrame(samp_rows, columns=SAMP_COLUMNS)
             edf = pd.DataFrame(exp_rows, columns=EXP_COLUMNS)
             rdf = pd.DataFrame(run_rows, columns=RUN_COLUMNS)
-            
-            # merge dataframes to files. 
-            merge_write_df(pdf, f'{self.metadir}/projects.tsv')            
-            merge_write_df(sdf, f'{self.metadir}/samples.tsv')
-            merge_write_df(edf, f'{self.metadir}/experiments.tsv')
-            merge_write_df(rdf, f'{self.metadir}/runs.tsv')
-
-            self.log.info(f'successfully processed project {projectid}')
-            # return projectid only if it has completed successfully.
-            return projectid
+            return (pdf, sdf, edf, rdf)
 
         except Exception as ex:
             self.log.error(f'problem with NCBI projectid {projectid}')
             logging.error(traceback.format_exc(None))
             raise ex
 
+    def write(self, dfs):
+        """
+        Merge (pdf, sdf, edf, rdf) from query() into the metadata store. 
+        Not thread-safe: call from one writer only. 
+
+        """
+        (pdf, sdf, edf, rdf) = dfs
+        self.store.merge('projects', pdf)
+        self.store.merge('samples', sdf)
+        self.store.merge('experiments', edf)
+        self.store.merge('runs', rdf)
+
     def query_experiment_package_set(self, xid):
         """
         Query XML data for this experiment ID. 
@@ -279,47 +326,92 @@ class Query(object):
         try:
             url = f"{self.sra_efetch}&id={xid}"
             self.log.debug(f"fetch url={url}")
-
-            while True:
-                r = requests.post(url)
-                if r.status_code == 200:
-                    xmldata = r.content.decode()
-                    self.log.debug(f'good HTTP response for {xid}')
-                    break
-                else:
-                    self.log.warn(
-                        f'bad HTTP response for id {xid}. retry in 10s')
-                    time.sleep(10)
+            r = self.client.post(url)
+            if r.status_code == 200:
+                xmldata = r.content.decode()
+                self.log.debug(f'good HTTP response for {xid}')
+            else:
+                self.log.warn(
+                    f'bad HTTP response {r.status_code} for id {xid}.')
 
         except Exception as ex:
             self.log.error(f'problem with NCBI id {xid}')
             logging.error(traceback.format_exc(None))
 
-        finally:
-            self.log.debug(
-                f"sleeping {self.query_sleep} secs between fetch calls...")
-            time.sleep(self.query_sleep)
         return xmldata
 
+    def query_experiment_package_batch(self, explist):
+        """
+        Query and parse XML data for a list of experiment IDs with one efetch call. 
+        If the batch fails, split it in half and query each half, down to 
+        single ids, so only the bad ids are lost. 
+        Returns list of (proj_rows, samp_rows, exp_rows, run_rows), one per successful sub-batch. 
+
+        """
+        rowsets = []
+        xids = ','.join(explist)
+        rows = self._fetch_package_set(xids)
+        if rows is not None:
+            rowsets.append(rows)
+        elif len(explist) > 1:
+            half = len(explist) // 2
+            self.log.warning(
+                f'batch of {len(explist)} failed. splitting into {half} and {len(explist) - half}')
+            rowsets.extend(self.query_experiment_package_batch(explist[:half]))
+            rowsets.extend(self.query_experiment_package_batch(explist[half:]))
+        else:
+            self.log.warning(f'giving up on experiment id {xids}')
+        return rowsets
+
+    def _fetch_package_set(self, xids, tries=3):
+        """
+        POST comma-joined ids to efetch and parse the response body as it streams in. 
+        Returns None on failure so caller can split. The client retries HTTP errors, 
+        errors while streaming the body are retried here <tries> times, 
+        bad XML/records are not retried. 
+
+        """
+        rows = None
+        url = f"{self.sra_efetch}&id={xids}"
+        self.log.debug(f"fetch url={url}")
+        for i in range(tries):
+            try:
+                with self.client.post(url, stream=True) as r:
+                    if r.status_code == 200:
+                        r.raw.decode_content = True
+                        rows = self.parse_experiment_package_set(r.raw)
+                        self.log.debug(f'good HTTP response for {xids}')
+                    else:
+                        self.log.warn(
+                            f'bad HTTP response {r.status_code} for ids {xids}.')
+                break
+            except (ChunkedEncodingError, urllib3.exceptions.HTTPError) as cee:
+                self.log.warning(f'got streaming error for ids {xids}: {cee} try {i + 1}')
+            except Exception as ex:
+                self.log.error(f'problem with NCBI ids {xids}')
+                logging.error(traceback.format_exc(None))
+                break
+        return rows
 
-    def parse_experiment_package_set(self, xmlstr):
+    def parse_experiment_package_set(self, xmldata):
         """
         package sets should have one package per uid pulled via efetch, e.g.
 
         https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=sra&id=12277089,12277091
         https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=sra&id=13333495 
 
+        xmldata is an XML string or a binary file-like object, e.g. a streamed HTTP response body. 
+
         """
-        root = et.fromstring(xmlstr)
-        self.log.debug(f"root={root}")
+        if isinstance(xmldata, str):
+            xmldata = io.BytesIO(xmldata.encode())
         proj_rows = []
         samp_rows = []
         exp_rows = []
         run_rows = []
 
         n_processed = 0
-        for exp in root.iter("EXPERIMENT_PACKAGE"):
-            (projrow, samprow, exprow, newruns) = self.parse_experiment_package(exp)
+        for (projrow, samprow, exprow, newruns) in self.iterparse_experiment_package_set(xmldata):
             proj_rows.append(projrow)
             samp_rows.append(samprow)
             exp_rows.append(exprow)
@@ -332,6 +424,24 @@ class Query(object):
             f'returning\n    proj_rows: {proj_rows}\n    exp_rows: {exp_rows} \n    run_rows: {run_rows}')
         return (proj_rows, samp_rows, exp_rows, run_rows)
 
+    def iterparse_experiment_package_set(self, source):
+        """
+        Incrementally parse binary file-like source, yielding 
+            (projrow, samprow, exprow, runrows) 
+        per EXPERIMENT_PACKAGE. Finished packages are cleared from the tree, 
+        so memory doesn't grow with the number of packages. 
+
+        """
+        context = iter(et.iterparse(source, events=('start', 'end')))
+        (event, root) = next(context)
+        self.log.debug(f"root={root}")
+        for (event, elem) in context:
+            if event == 'end' and elem.tag == 'EXPERIMENT_PACKAGE':
+                yield self.parse_experiment_package(elem)
+                elem.clear()
+                # drop references held by the package set to finished packages.
+                root.clear()
+
     def parse_experiment_package(self, root):
         """
         NCBI provides no XSD, so we shouldn't rely on order
@@ -414,7 +524,13 @@ class Query(object):
         taxon = pool.find('Member').get('tax_id')
         organism = pool.find('Member').get('organism')
 
-        nreads = run.find('Statistics').get('nreads')
+        stats = run.find('Statistics')
+        nreads = stats.get('nreads')
+        # average length per read, in read index order. lets impute skip fastq-dump.
+        read_lengths = []
+        for read in stats.findall('Read'):
+            read_lengths.append(int(round(float(read.get('average', 0)))))
+        read_lengths = str(read_lengths)
 
         bases = run.find('Bases')
         basecounts = {}
@@ -426,7 +542,7 @@ class Query(object):
         basecounts = str(basecounts)
 
         runrow = [run_id, run_ext_ids, total_spots, total_bases, size, pdate,
-                  taxon, organism, nreads,  basecounts, expid, sampleid]
+                  taxon, organism, nreads,  basecounts, read_lengths, expid, sampleid]
 
         return runrow
 
@@ -625,8 +741,78 @@ class PrefetchRun(object):
             self.outlist.append(self.runid)
 
 
+class DownloadRun(object):
+    '''
+    Native download of one run's .sra to <cachedir>/<runid>.sra, from its runinfo 
+    download_path, with parallel range requests and a resumable chunk journal. 
+    Checked against runinfo RunHash (md5) and the metadata size (within 1%, at least 1MB,
+    since runinfo only gives size_MB). 
+    Falls back to prefetch if there is no url, or the native download fails. 
+    Waits for <size> bytes of cache budget first, and registers the .sra with the 
+    cache manager for the analysis stage. If the budget can't be had, the run is 
+    deferred (not in outlist). With reserved, the caller already reserved <size> 
+    (e.g. for the whole project), and this run only gives its share back when done. 
+    A run whose .sra is already in the cache isn't fetched again. 
+    execute() returns the bytes downloaded, 0 if the run failed, was deferred or was cached. 
+    '''
+
+    def __init__(self, config, runid, outlist, url=None, md5=None, size=0, proj_id=None,
+                 reserved=False):
+        self.log = logging.getLogger('sra')
+        self.config = config
+        self.runid = runid
+        self.outlist = outlist
+        self.url = url
+        self.md5 = md5
+        self.size = size
+        self.proj_id = proj_id
+        self.reserved = reserved
+        self.sracache = os.path.expanduser(self.config.get('download', 'cachedir'))
+        self.engine = self.config.get('download', 'engine')
+        if self.config.get('download', 'verify_md5').lower() != 'yes':
+            self.md5 = None
+
+    def execute(self):
+        cache = get_cache(self.config)
+        if os.path.exists(sra_path(self.sracache, self.runid)):
+            self.log.debug(f'{self.runid} already downloaded')
+            self.outlist.append(self.runid)
+            return 0
+        if not self.reserved and not cache.reserve(self.size):
+            self.log.info(f'no cache space for {self.runid}. deferred.')
+            return 0
+        try:
+            self._fetch()
+        finally:
+            cache.unreserve(self.size)
+        # prefetch logs its own failures and returns normally.
+        if self.runid not in self.outlist:
+            self.log.warning(f'unable to download {self.runid}')
+            return 0
+        path = sra_path(self.sracache, self.runid)
+        cache.register(path, 'download', 'analysis', self.runid, self.proj_id)
+        return os.path.getsize(path)
+
+    def _fetch(self):
+        if self.engine == 'native' and self.url is not None:
+            try:
+                dl = RangeDownloader(
+                    chunksize=int(self.config.get('download', 'chunk_mb')) * MB,
+                    streams=int(self.config.get('download', 'chunk_streams')))
+                size = None
+                if self.size > 0:
+                    size = self.size
+                dl.fetch(self.url, f'{self.sracache}/{self.runid}.sra', md5=self.md5,
+                         size=size, slack=max(MB, self.size // 100))
+                self.outlist.append(self.runid)
+                return
+            except Exception as ex:
+                self.log.warning(f'native download failed for {self.runid}: {ex}. trying prefetch.')
+        PrefetchRun(self.config, self.runid, self.outlist).execute()
+
+
 # inputs are the runs completed by prefetch
-# assumes path is cachedir/<run>.sra
+# path is resolved with sra_path(), native downloads and prefetch differ.
 # JL is satisfied with this 6/4/2021
 class FasterqDump(object):
     '''
@@ -660,7 +846,7 @@ class FasterqDump(object):
 
     '''
 
-    def __init__(self, config, srrid, outlist):
+    def __init__(self, config, srrid, outlist, nreads=None, proj_id=None):
         self.log = logging.getLogger('sra')
         self.srrid = srrid
 
@@ -668,12 +854,22 @@ class FasterqDump(object):
         self.config = config
         self.cachedir = os.path.expanduser(
             self.config.get('download', 'cachedir'))
+        self.tempdir = os.path.expanduser(
+            self.config.get('download', 'tempdir'))
         self.num_streams = self.config.get('download', 'num_streams')
+        # plain: <srrid>_<n>.fastq   gzip: <srrid>_<n>.fastq.gz (BGZF)
+        self.fastq_format = self.config.get('download', 'fastq_format')
+        self.compress_threads = int(self.config.get('download', 'compress_threads'))
+        self.compress_level = int(self.config.get('download', 'compress_level'))
+        self.nreads = nreads
+        self.proj_id = proj_id
 
         self.outlist = outlist
 
     def execute(self):
         self.log.debug(f'downloading id {self.srrid}')
+        if self.fastq_format == 'gzip' and self.nreads is not None:
+            return self._execute_gzip()
 
         loglev = LOGLEVELS[self.log.getEffectiveLevel()]
         # os.system("    + " -O "+fastqdirec+ " "+ fastqprefix +".sra" )
@@ -684,7 +880,7 @@ class FasterqDump(object):
                '--threads', f'{self.num_streams}',
                '--outdir', f'{self.cachedir}/',
                '--log-level', f'{loglev}',
-               f'{self.cachedir}/{self.srrid}.sra']
+               sra_path(self.cachedir, self.srrid)]
 
         cmdstr = " ".join(cmd)
         logging.debug(f"Fasterq-dump command: {cmdstr} running...")
@@ -693,23 +889,249 @@ class FasterqDump(object):
             f"Ran cmd='{cmdstr}' returncode={cp.returncode} {type(cp.returncode)} ")
         # successful runs - append to outlist.
         if str(cp.returncode) == "0":
+            if self.fastq_format == 'gzip':
+                # read count unknown, so no streaming. compress what fasterq-dump wrote. 
+                for fq in glob.glob(f'{self.cachedir}/{self.srrid}_*.fastq'):
+                    self._compress(fq, f'{fq}.gz')
+                    os.remove(fq)
+            self._register()
             self.outlist.append(self.srrid)
 
+    def _register(self):
+        cache = get_cache(self.config)
+        for fq in glob.glob(f'{self.cachedir}/{self.srrid}_*.fastq*'):
+            cache.register(fq, 'dump', 'analysis', self.srrid, self.proj_id)
+
+    def _execute_gzip(self):
+        '''
+        fastq-dump into named pipes, each compressed to BGZF as it streams, 
+        so uncompressed fastq never touches disk. 
+        '''
+        stream = FastqDumpStream(self.config, [(self.srrid, self.nreads)],
+                                 f'{self.tempdir}/{self.srrid}.gz.fifo')
+        stream.start()
+        results = {}
+        threads = []
+        for fifo in stream.fifos(self.srrid, self.nreads):
+            outfile = f'{self.cachedir}/{os.path.basename(fifo)}.gz'
+            t = Thread(target=self._compress_part, args=(fifo, outfile, results))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        ok = stream.wait() and all(results.values())
+        stream.cleanup()
+        for outfile in results:
+            if ok:
+                os.replace(f'{outfile}.part', outfile)
+            elif os.path.exists(f'{outfile}.part'):
+                os.remove(f'{outfile}.part')
+        if ok:
+            self._register()
+            self.outlist.append(self.srrid)
+        else:
+            self.log.warning(f'compressed fastq dump failed for {self.srrid}')
 
-def get_runs_for_project(config, projectid):
-    """
+    def _compress_part(self, src, outfile, results):
+        results[outfile] = False
+        try:
+            self._compress(src, f'{outfile}.part')
+            results[outfile] = True
+        except Exception as ex:
+            self.log.error(f'unable to compress {src}: {ex}')
+
+    def _compress(self, src, dest):
+        bgzf_compress(src, dest, self.compress_threads, self.compress_level)
+
+
+class FastqDumpStream(object):
+    '''
+    Streams fastq-dump output into named pipes, so a consumer (STAR) reads fastq 
+    without it ever being written to disk. 
+
+    For each (srrid, nreads) run, pipes <fifodir>/<srrid>_<i>.fastq are made for reads 
+    1..nreads, the names fastq-dump --split-files writes. Runs are dumped one after 
+    another in the given order, which must be the order the consumer opens them 
+    (readFilesIn, readFilesManifest). Pipes not in <used> (e.g. index reads) are 
+    drained and discarded, so the dump never blocks on them. 
+    While a run is dumped its pipes are also held open read/write here, so neither side 
+    blocks in open() whatever order they open files in (STAR opens the cDNA read first). 
+    Readers get EOF once the dump exits and the pipes are released. 
+
+    The consumer only sees EOF, so success requires wait() to be True as well. 
+    '''
 
+    def __init__(self, config, runs, fifodir, used=None):
+        self.log = logging.getLogger('sra')
+        self.config = config
+        self.runs = runs
+        self.fifodir = fifodir
+        self.used = used
+        self.sracache = os.path.expanduser(self.config.get('download', 'cachedir'))
+        self.returncodes = {}
+        self.aborted = False
+        self.proc = None
+        self.feeder = None
+
+    def fifos(self, srrid, nreads):
+        return [f'{self.fifodir}/{srrid}_{i + 1}.fastq' for i in range(int(nreads))]
+
+    def start(self):
+        os.makedirs(self.fifodir, exist_ok=True)
+        for (srrid, nreads) in self.runs:
+            for fifo in self.fifos(srrid, nreads):
+                if os.path.exists(fifo):
+                    os.remove(fifo)
+                os.mkfifo(fifo)
+        self.feeder = Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _drain(self, fifo):
+        with open(fifo, 'rb') as f:
+            while len(f.read(1024 * 1024)) > 0:
+                pass
+
+    def _feed(self):
+        loglev = LOGLEVELS[self.log.getEffectiveLevel()]
+        for (srrid, nreads) in self.runs:
+            if self.aborted:
+                break
+            drains = []
+            for fifo in self.fifos(srrid, nreads):
+                if self.used is not None and os.path.basename(fifo) not in self.used:
+                    t = Thread(target=self._drain, args=(fifo,), daemon=True)
+                    t.start()
+                    drains.append(t)
+            cmd = ['fastq-dump',
+                   '--split-files',
+                   '--outdir', f'{self.fifodir}/',
+                   '--log-level', f'{loglev}',
+                   sra_path(self.sracache, srrid)]
+            cmdstr = " ".join(cmd)
+            self.log.debug(f"fastq-dump stream command: {cmdstr} running...")
+            holders = [os.open(fifo, os.O_RDWR) for fifo in self.fifos(srrid, nreads)]
+            try:
+                self.proc = subprocess.Popen(cmd)
+                self.returncodes[srrid] = self.proc.wait()
+            except OSError as ex:
+                self.log.error(f'unable to run fastq-dump for {srrid}: {ex}')
+                self.returncodes[srrid] = -1
+            finally:
+                for fd in holders:
+                    os.close(fd)
+            self.log.debug(f"Ran cmd='{cmdstr}' returncode={self.returncodes[srrid]}")
+            for t in drains:
+                t.join()
+
+    def _unblock(self):
+        '''
+        Open each pipe's write end without blocking, so a consumer waiting in open() 
+        for a run that will no longer be dumped gets EOF instead of hanging. 
+        '''
+        for (srrid, nreads) in self.runs:
+            for fifo in self.fifos(srrid, nreads):
+                try:
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+
+    def abort(self):
+        '''
+        Consumer gave up. Stop the current dump and skip the rest. 
+        '''
+        self.aborted = True
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        self._unblock()
+
+    def wait(self):
+        '''
+        True if every run was dumped completely. 
+        '''
+        if self.feeder is not None:
+            self.feeder.join()
+        ok = not self.aborted and len(self.returncodes) == len(self.runs)
+        return ok and all(rc == 0 for rc in self.returncodes.values())
+
+    def cleanup(self):
+        shutil.rmtree(self.fifodir, ignore_errors=True)
+
+
+def get_runs_for_project(config, projectid, screen=False):
     """
-    metadir = os.path.expanduser(config.get('sra', 'metadir'))
-    filepath = f"{metadir}/project_runs.tsv"
-    if os.path.isfile(filepath):
-        pdf = pd.read_csv(filepath, sep='\t', index_col=0, comment="#")
-        return list(pdf[pdf.project == 'SRP281950'].run_id)
-    else:
+    Run ids for projectid, read via the metadata store index. 
+    With screen, runs too small to be worth aligning are left out (see screen_runs). 
+    """
+    try:
+        rdf = get_store(config, 'sra').read('runs', proj_id=projectid)
+        if screen:
+            rdf = screen_runs(config, rdf)
+        return list(rdf.run_id)
+    except Exception:
+        logging.getLogger('sra').warning(f'no run metadata for {projectid}')
         return []
 
 
-def query_project_metadata(project_id):
+def screen_runs(config, rdf):
+    """
+    Drop runs with too little data to be worth downloading and aligning, e.g. empty 
+    wells of a Smart-seq plate: tot_spots below min_run_spots, size below min_run_kb, 
+    or no reads (nreads 0). Runs with unknown values are kept. 
+    Needs run_id and any of tot_spots, size, nreads. Returns the kept rows. 
+    """
+    min_spots = int(config.get('sra', 'min_run_spots'))
+    min_bytes = int(float(config.get('sra', 'min_run_kb')) * 1024)
+    drop = pd.Series(False, index=rdf.index)
+    if 'tot_spots' in rdf.columns:
+        drop |= pd.to_numeric(rdf.tot_spots, errors='coerce') < min_spots
+    if 'size' in rdf.columns:
+        drop |= pd.to_numeric(rdf['size'], errors='coerce') < min_bytes
+    if 'nreads' in rdf.columns:
+        drop |= pd.to_numeric(rdf.nreads, errors='coerce') == 0
+    if drop.any():
+        logging.getLogger('sra').info(
+            f'screened out {drop.sum()} of {len(rdf)} runs below {min_spots} spots/{min_bytes} bytes')
+    return rdf[~drop]
+
+
+def get_run_sizes(config, projectid):
+    """
+    {run_id: size in bytes} for projectid from the runs metadata (SRA run 'size'). 
+    Unknown sizes are left out. 
+    """
+    try:
+        rdf = get_store(config, 'sra').read('runs', proj_id=projectid)
+    except Exception:
+        return {}
+    sizes = pd.to_numeric(rdf['size'], errors='coerce')
+    return {r: int(s) for (r, s) in zip(rdf.run_id, sizes) if not pd.isna(s)}
+
+
+def get_run_urls(config, projectid):
+    """
+    {run_id: (download_path, md5, size)} for projectid from SRA runinfo. 
+    RunHash is used as the md5, size (bytes) is from size_MB. Empty if runinfo is unavailable. 
+    """
+    log = logging.getLogger('sra')
+    try:
+        df = query_project_metadata(projectid, config)
+    except Exception:
+        log.warning(f'no runinfo for {projectid}. downloads will use prefetch.')
+        return {}
+    urls = {}
+    for (run, path, md5, sizemb) in zip(df.Run, df.download_path, df.RunHash, df.size_MB):
+        if isinstance(path, str) and path.startswith('http'):
+            if not isinstance(md5, str) or len(md5) != 32:
+                md5 = None
+            size = 0
+            if not pd.isna(sizemb):
+                size = int(float(sizemb) * MB)
+            urls[run] = (path, md5, size)
+    log.debug(f'got {len(urls)} run urls for {projectid}')
+    return urls
+
+
+def query_project_metadata(project_id, config=None):
     '''
     E.g. https://trace.ncbi.nlm.nih.gov/Traces/sra/sra.cgi?db=sra&rettype=runinfo&save=efetch&term=SRP131661
 
@@ -717,7 +1139,10 @@ def query_project_metadata(project_id):
 
     '''
     log = logging.getLogger('sra')
-    url = "https://trace.ncbi.nlm.nih.gov/Traces/sra/sra.cgi"
+    url = SRA_RUNINFO
+    if config is not None and config.has_option('sra', 'sra_runinfo'):
+        url = config.get('sra', 'sra_runinfo')
+    host = urllib.parse.urlparse(url).netloc
 
     headers = {
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
@@ -726,10 +1151,10 @@ def query_project_metadata(project_id):
         "Cache-Control": "no-cache",
         "Connection": "keep-alive",
         "DNT": "1",
-        "Host": "trace.ncbi.nlm.nih.gov",
-        "Origin": "http://trace.ncbi.nlm.nih.gov",
+        "Host": host,
+        "Origin": f"http://{host}",
         "Pragma": "no-cache",
-        "Referer": "http://trace.ncbi.nlm.nih.gov/Traces/sra/sra.cgi?db=sra",
+        "Referer": f"{url}?db=sra",
         "User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 6_0 like Mac OS X) AppleWebKit/536.26 (KHTML, like Gecko) Version/6.0 Mobile/10A5376e Safari/8536.25"}
 
     payload = {
@@ -740,7 +1165,7 @@ def query_project_metadata(project_id):
 
     df = None
     log.debug('opening request...')
-    r = requests.put(url, data=payload, headers=headers, stream=True)
+    r = get_client(config).put(url, data=payload, headers=headers)
     if r.status_code == 200:
         log.info('got good return. reading CSV to dataframe.')
         with io.BytesIO(r.content) as imf:
@@ -772,7 +1197,7 @@ def query_all_uids(config):
         try:
             url = f"{sra_esearch}&term={search_term}&retstart={query_start}&retmax={query_max}&retmode=json"
             log.debug(f"search url: {url}")
-            r = requests.get(url)
+            r = get_client(config).get(url)
             er = json.loads(r.content.decode('utf-8'))
             #log.debug(f"er: {er}")
             idlist = er['esearchresult']['idlist']
@@ -800,11 +1225,11 @@ def query_project_for_uidlist_byone(config, uidlist):
     for uid in uidlist:
         log.debug(f'handling single uid: {uid}')
         tuplist = query_project_for_uidlist(config, [uid])
+        if tuplist is None:
+            log.warning(f'Problem querying during special handling. uid {uid}')
+            continue
         for tup in tuplist:
-            if tup is not None:
-                tuples.append(tup)
-            else:
-                log.warning(f'Problem querying during special handling. uid {uid}')
+            tuples.append(tup)
     log.warning(f'returning special tuplelist: {tuples}')
     return tuples
 
@@ -818,46 +1243,39 @@ def query_project_for_uidlist(config, uidlist):
     uids = ','.join(uidlist)
     url = f"{sra_efetch}&id={uids}"
     log.info(f"fetching url={url}")
-    tries = 0
-    while True:
-        try:
-            tuples = []
-            r = requests.post(url)
-            if r.status_code == 200:
-                rd = r.content.decode()
-                root = et.fromstring(rd)
-                expkgs = root.findall('EXPERIMENT_PACKAGE')
-                for exppkg in expkgs:
-                    exp = exppkg.find('EXPERIMENT')
-                    exp_id = exp.get('accession')
-                    proj_id = exp.find('STUDY_REF').get('accession')
-                    log.debug(f'exp_id: {exp_id} proj_id: {proj_id}')
-                    tuples.append( (exp_id, proj_id) )
-            time.sleep(0.5)
-            return tuples
-        
-        except ChunkedEncodingError as cee:
-            log.warning(f'got ChunkedEncodingError error for uidlist {uids}: {cee}')
-            tries += 1
-            if tries >= 3 and len(uidlist) == 1:
-                log.warning(f'got ChunkedEncodingError for uid: {uidlist[0]} Giving up, returning None.')
-                return None
-            elif tries >= 3:
-                log.warning(f'got too many ChunkedEncodingErrors for uidlist {uidlist}. Doing one-by-one...')
-                tuples = query_project_for_uidlist_byone(config, uidlist)
-                return tuples
-            else:
-                log.warning(f'got ChunkedEncodingError. Try {tries}')
-            time.sleep(0.5)                
-            
-            
-        except ConnectionError as ce:
-            log.warning(f'got connection error for uidlist {uids}: {ce}')
-            time.sleep(30)
+    try:
+        r = get_client(config).post(url)
+        if r.status_code == 200:
+            return parse_uidlist_response(r.content)
+        log.warning(f'bad HTTP response {r.status_code} for uidlist {uids}')
+        return []
 
-        except Exception as e:
-            log.warning(f'got another exception for uidlist {uids}: {e}  ')
+    except ChunkedEncodingError as cee:
+        # client has already retried. 
+        if len(uidlist) == 1:
+            log.warning(f'got ChunkedEncodingError for uid: {uidlist[0]} Giving up, returning None.')
             return None
+        log.warning(f'got too many ChunkedEncodingErrors for uidlist {uidlist}. Doing one-by-one...')
+        return query_project_for_uidlist_byone(config, uidlist)
+
+    except Exception as e:
+        log.warning(f'got another exception for uidlist {uids}: {e}  ')
+        return None
+
+
+def parse_uidlist_response(content):
+    """
+    Pull (exp_id, proj_id) tuples out of an efetch EXPERIMENT_PACKAGE_SET response body. 
+    """
+    log = logging.getLogger('sra')
+    tuples = []
+    for (event, exp) in et.iterparse(io.BytesIO(content)):
+        if exp.tag == 'EXPERIMENT':
+            exp_id = exp.get('accession')
+            proj_id = exp.find('STUDY_REF').get('accession')
+            log.debug(f'exp_id: {exp_id} proj_id: {proj_id}')
+            tuples.append( (exp_id, proj_id) )
+    return tuples
 
 
 # should  this be moved to query? download?
@@ -1028,18 +1446,32 @@ if __name__ == "__main__":
         tuplist = []
         curid = 0
         batchsize = int(cp.get('sra','uid_batchsize'))
-        efetch_sleep = float(cp.get('sra','query_sleep'))
+        client = get_client(cp)
+        sra_efetch = cp.get('sra', 'sra_efetch')
+        # fetch max_inflight batches at a time concurrently, still within the rate limit.
+        nbatches = client.max_inflight
         
         with open(args.outfile, 'w') as f:
             while curid < len(uidlist):
-                dolist = uidlist[curid:curid + batchsize]
-                outtups = query_project_for_uidlist(cp, dolist)
-                for (expid, projid) in outtups:
-                    if projid is not None and expid is not None :
-                        f.write(f'{expid} {projid}\n')
-                        f.flush()
-                    else:
-                        logging.warning('exp_id or proj_id is None. Ignoring... ')
-                curid += batchsize
-            time.sleep(efetch_sleep)
+                dolists = [ uidlist[i:i + batchsize] for i in 
+                            range(curid, min(curid + batchsize * nbatches, len(uidlist)), batchsize) ]
+                urls = [ f"{sra_efetch}&id={','.join(dolist)}" for dolist in dolists ]
+                responses = client.gather('POST', urls)
+                for (dolist, r) in zip(dolists, responses):
+                    try:
+                        if isinstance(r, Exception) or r.status_code != 200:
+                            raise Exception(f'bad response {r}')
+                        outtups = parse_uidlist_response(r.content)
+                    except Exception:
+                        # sync path has the one-by-one fallback
+                        outtups = query_project_for_uidlist(cp, dolist)
+                    if outtups is None:
+                        continue
+                    for (expid, projid) in outtups:
+                        if projid is not None and expid is not None :
+                            f.write(f'{expid} {projid}\n')
+                            f.flush()
+                        else:
+                            logging.warning('exp_id or proj_id is None. Ignoring... ')
+                curid += batchsize * nbatches
                 
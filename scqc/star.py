@@ -4,6 +4,7 @@
 #
 
 import argparse
+import atexit
 import glob
 import io
 import itertools
@@ -14,6 +15,7 @@ import re
 import requests
 import subprocess
 import sys
+import threading
 import time
 import urllib
 import ast
@@ -24,19 +26,290 @@ from queue import Queue, Empty
 from requests.exceptions import ChunkedEncodingError
 
 import xml.etree.ElementTree as et
-import pandas as pd
-import numpy as np
 
 gitpath = os.path.expanduser("~/git/scqc")
 sys.path.append(gitpath)
 
 from scqc.utils import *
+# heavy, imported on first use
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+from scqc.metastore import get_store
+from scqc.sra import FasterqDump, FastqDumpStream, screen_runs
+from scqc.cache import get_cache, GB
 # inputs should be runs  identified as 'some10x'
 # fastq files should already downloaded.
 # srrid and species needs to be passed in from the dataframe
 # can pass star parameters from config
 
 
+class SharedGenome(object):
+    '''
+    One STAR genome index held in shared memory, shared by all alignments in this process. 
+
+    acquire() loads it on first use (STAR --genomeLoad LoadAndExit). Alignments then run 
+    with --genomeLoad LoadAndKeep and attach to the resident copy, instead of each loading 
+    a private ~30GB one. release() after each alignment. The genome stays resident between 
+    alignments and is removed by unload() (STAR --genomeLoad Remove), at exit at the latest. 
+    '''
+
+    def __init__(self, genomedir, tempdir):
+        self.log = logging.getLogger('star')
+        self.genomedir = genomedir
+        # STAR writes Log.out etc. even for load/remove.
+        self.prefix = f'{tempdir}/genomeload_{os.path.basename(os.path.dirname(genomedir))}_'
+        self.refs = 0
+        self.loaded = False
+        self.cond = threading.Condition()
+
+    def _star(self, mode):
+        cmd = ['STAR', '--genomeLoad', mode, '--genomeDir', self.genomedir,
+               '--outFileNamePrefix', self.prefix, '--outSAMtype', 'None']
+        self.log.debug(f'STAR command: {" ".join(cmd)} running...')
+        try:
+            cp = subprocess.run(cmd)
+            rc = cp.returncode
+        except OSError as ex:
+            self.log.error(f'unable to run STAR: {ex}')
+            rc = -1
+        if rc != 0:
+            self.log.warning(f'STAR --genomeLoad {mode} failed for {self.genomedir} rc={rc}')
+        return rc == 0
+
+    def acquire(self):
+        '''
+        Take a reference, loading the genome if needed. 
+        False if it couldn't be loaded (e.g. not enough shared memory), no reference taken. 
+        '''
+        with self.cond:
+            if not self.loaded:
+                self.log.info(f'loading {self.genomedir} into shared memory')
+                self.loaded = self._star('LoadAndExit')
+            if self.loaded:
+                self.refs += 1
+            return self.loaded
+
+    def release(self):
+        with self.cond:
+            self.refs -= 1
+            self.cond.notify_all()
+
+    def unload(self, timeout=None):
+        '''
+        Remove the genome from shared memory, after waiting up to timeout for running 
+        alignments to release it. 
+        '''
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.refs <= 0, timeout):
+                self.log.warning(f'removing {self.genomedir} with {self.refs} alignments attached')
+            if self.loaded:
+                self.log.info(f'removing {self.genomedir} from shared memory')
+                self._star('Remove')
+                self.loaded = False
+
+
+_genomes = {}
+_genomes_lock = threading.Lock()
+
+
+def get_shared_genome(genomedir, tempdir):
+    '''
+    Process-wide SharedGenome per index, so concurrent alignments share one reference count. 
+    '''
+    with _genomes_lock:
+        if genomedir not in _genomes:
+            _genomes[genomedir] = SharedGenome(genomedir, tempdir)
+        return _genomes[genomedir]
+
+
+def unload_genomes(timeout=None):
+    '''
+    Remove every genome this process loaded into shared memory. 
+    '''
+    with _genomes_lock:
+        genomes = list(_genomes.values())
+    for genome in genomes:
+        genome.unload(timeout)
+
+
+# shared memory outlives the process otherwise. 
+atexit.register(unload_genomes, 0)
+
+
+class AlignJob(object):
+    '''
+    One STAR alignment: a 10x run, or all Smart-seq runs of a project (one manifest). 
+    size is the input bytes (.sra), NaN if unknown. 
+    run(nthreads) calls func(*args, nthreads=nthreads), True if aligned. 
+    '''
+
+    def __init__(self, proj_id, runs, size, func, *args):
+        self.proj_id = proj_id
+        self.runs = runs
+        self.size = size
+        self.func = func
+        self.args = args
+        self.ok = False
+        self.done = False
+
+    def run(self, nthreads):
+        self.ok = self.func(*self.args, nthreads=nthreads)
+        return self.ok
+
+
+class AlignScheduler(object):
+    '''
+    Runs AlignJobs concurrently, packed onto the node's cores and memory. 
+
+    Each job asks for one thread per gb_per_thread GB of input, between min_threads 
+    and ncore_align (ncore_align if size unknown), and gets what is free if that is 
+    at least min_threads. Each job needs job_mem_gb, plus genome_mem_gb unless the 
+    genome is shared (then counted once). With genomeload=shared the genome is loaded 
+    before scheduling; if that fails, jobs fall back to private genomes and are charged 
+    for them. Largest jobs start first, smaller ones fill the leftover cores. 
+    A job that can never fit still runs, alone. 
+
+    One scheduler should own the node: several threads may call run() on it at once, 
+    and their jobs share the same cores and memory. 
+
+    Config:
+        [analysis] max_cores, max_mem_gb    0 for the whole node. 
+        [star] genome_mem_gb, job_mem_gb, gb_per_thread, min_threads, ncore_align
+    '''
+
+    def __init__(self, config):
+        self.log = logging.getLogger('star')
+        self.cores = int(config.get('analysis', 'max_cores'))
+        if self.cores <= 0:
+            self.cores = os.cpu_count()
+        mem = float(config.get('analysis', 'max_mem_gb')) * GB
+        if mem <= 0:
+            mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        self.genome_mem = float(config.get('star', 'genome_mem_gb')) * GB
+        self.job_mem = float(config.get('star', 'job_mem_gb')) * GB
+        self.genomeload = config.get('star', 'genomeload')
+        resourcedir = os.path.expanduser(config.get('star', 'resourcedir'))
+        self.genomedir = f"{resourcedir}/genomes/{config.get('star', 'species')}/STAR_index"
+        self.tempdir = os.path.expanduser(config.get('star', 'tempdir'))
+        # genome in shared memory, charged once. None until tried.
+        self.shared = None
+        self.loading = False
+        self.mem = mem
+        self.gb_per_thread = float(config.get('star', 'gb_per_thread'))
+        self.min_threads = int(config.get('star', 'min_threads'))
+        self.max_threads = max(self.min_threads, int(config.get('star', 'ncore_align')))
+        self.pending = []
+        self.freecores = self.cores
+        self.freemem = self.mem
+        self.running = 0
+        self.cond = threading.Condition()
+
+    def add(self, job):
+        with self.cond:
+            self.pending.append(job)
+            self.pending.sort(key=lambda j: -1 if pd.isna(j.size) else j.size, reverse=True)
+            self.cond.notify_all()
+
+    def _load_genome(self):
+        '''
+        With genomeload=shared, load the genome (if not yet resident) before any job starts, 
+        so memory is accounted for the way the jobs will actually run. 
+        STAR runs without holding cond, so running jobs can finish meanwhile. Other callers 
+        wait for the outcome. 
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: not self.loading)
+            if self.shared is not None:
+                return
+            if self.genomeload != 'shared':
+                self.shared = False
+                return
+            self.loading = True
+        shared = False
+        try:
+            genome = get_shared_genome(self.genomedir, self.tempdir)
+            # stays resident after release(), until unload_genomes()
+            shared = genome.acquire()
+            if shared:
+                genome.release()
+        finally:
+            with self.cond:
+                self.shared = shared
+                self.loading = False
+                if shared:
+                    self.freemem -= self.genome_mem
+                else:
+                    self.log.warning(f'shared genome load failed. charging each job '
+                                     f'{self.genome_mem / GB:.0f}GB for a private genome.')
+                self.cond.notify_all()
+
+    def mem_for(self, job):
+        if self.shared:
+            return self.job_mem
+        return self.job_mem + self.genome_mem
+
+    def threads_for(self, job):
+        if pd.isna(job.size):
+            return self.max_threads
+        n = int(np.ceil(job.size / (self.gb_per_thread * GB)))
+        return min(self.max_threads, max(self.min_threads, n))
+
+    def _next(self):
+        '''
+        (job, nthreads) for the largest pending job that fits now, or None. Holds cond. 
+        '''
+        for job in self.pending:
+            want = self.threads_for(job)
+            if self.running == 0:
+                # nothing else running: the job runs, whatever it asks for. 
+                return (job, min(want, max(self.cores, 1)))
+            if self.freecores >= self.min_threads and self.freemem >= self.mem_for(job):
+                return (job, min(want, self.freecores))
+        return None
+
+    def run(self, jobs=None):
+        '''
+        Add jobs (if given) and run them, or everything added so far. Returns when those 
+        jobs have finished. Results are in job.ok 
+        Concurrent callers each start whatever fits next, whoever's job it is. 
+        '''
+        for job in jobs or []:
+            self.add(job)
+        self._load_genome()
+        with self.cond:
+            if jobs is None:
+                jobs = list(self.pending)
+            self.log.info(f'aligning {len(jobs)} jobs on {self.cores} cores, '
+                          f'{self.mem / GB:.0f}GB memory, {self.running} already running')
+            while not all(job.done for job in jobs):
+                nxt = self._next()
+                if nxt is None:
+                    self.cond.wait()
+                    continue
+                (job, nthreads) = nxt
+                mem = self.mem_for(job)
+                self.pending.remove(job)
+                self.running += 1
+                self.freecores -= nthreads
+                self.freemem -= mem
+                t = threading.Thread(target=self._execute, args=(job, nthreads, mem))
+                t.start()
+
+    def _execute(self, job, nthreads, mem):
+        self.log.debug(f'aligning {job.proj_id} {job.runs[:3]} with {nthreads} threads')
+        try:
+            job.run(nthreads)
+        except Exception as ex:
+            self.log.error(f'problem aligning {job.proj_id} {job.runs[:3]}: {ex}')
+            logging.error(traceback.format_exc(None))
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.freecores += nthreads
+                self.freemem += mem
+                job.done = True
+                self.cond.notify_all()
+
 
 class AlignReads(object):
     '''
@@ -56,48 +329,92 @@ class AlignReads(object):
     
         self.metadir= os.path.expanduser(
             self.config.get('star', 'metadir'))
+        self.store = get_store(self.config, 'star')
         self.resourcedir = os.path.expanduser(
             self.config.get('star', 'resourcedir'))
-        self.species = self.config.get('star', 'tempdir')
+        self.species = self.config.get('star', 'species')
+        # where download/fasterq-dump put .sra and fastq files
+        self.cachedir = os.path.expanduser(
+            self.config.get('download', 'cachedir'))
         
         self.outputdir= os.path.expanduser(
             self.config.get('star', 'outputdir'))
-        # self.outlist = outlist
+        # file: fasterq-dump to cachedir, then STAR reads files. 
+        # stream: fastq-dump into named pipes STAR reads directly. 
+        self.readmode = self.config.get('star', 'readmode')
+        # cached fastq may be compressed (BGZF)
+        self.fastq_ext = ''
+        if self.config.get('download', 'fastq_format') == 'gzip':
+            self.fastq_ext = '.gz'
+        self.outlist = []
         self.ncore_align = self.config.get('star', 'ncore_align')
+        self.genomedir = f'{self.resourcedir}/genomes/{self.species}/STAR_index'
+        # shared: one resident copy of the genome for all alignments (see SharedGenome)
+        self.genomeload = self.config.get('star', 'genomeload')
+        # runs aligned so far, so a partly aligned project resumes where it stopped
+        self.aligned = TrackedList(f'{self.metadir}/aligned-runs.txt')
+        # aligned runs' .sra/fastq become evictable
+        self.cache = get_cache(self.config)
 
         self.log.debug(f'initializing STAR alignment for {srpid}')
         self.srpid=srpid
 
 
     def execute(self):
+        '''
+        Align all supported runs of the project, one job after another. 
+        Returns True if every supported run aligned. Aligned runs are in self.outlist
+        '''
+        ok = True
+        for job in self.jobs():
+            ok = job.run(int(self.ncore_align)) and ok
+        return ok
+
+    def jobs(self):
+        '''
+        AlignJobs for the project's runs not yet aligned: one per 10x run, one for all 
+        Smart-seq runs (they share a Solo.out, so it is redone unless all are aligned). 
+        '''
         # get relevant metadata
         rdf = self._get_meta_data()
+        self.aligned.refresh()
+        jobs = []
         # split by technology and parses independently based on tech
         for tech, df in rdf.groupby(by = "tech") :
+            # screened runs were never downloaded. projects imputed before screening 
+            # may still list them (e.g. empty Smart-seq cells).
+            df = screen_runs(self.config, df)
             # smartseq runs
             if tech =="smartseq":
-                # build the manifest
-                (manipath, manifest) = self._make_manifest(df) 
-                # run star
-                self._run_star_smartseq(manipath,manifest)
+                if len(df) == 0 or set(df.run_id).issubset(self.aligned.itemset):
+                    continue
+                size = pd.to_numeric(df['size'], errors='coerce')
+                jobs.append(AlignJob(self.srpid, list(df.run_id), size.sum(min_count=1), 
+                                     self._align_smartseq, df))
             
             # 10x runs
-            if tech.startswith('10xv'): 
-                # grab star params
-                # for run in run_ids
-                #    run star
-                for row in df.shape[0]:
-                    srrid = df.run_id[row]
-                    read1 = df.read1[row]
-                    read2 = df.read2[row]
-                    # saves to disk
-                    self._run_star_10x(srrid, tech, read1,read2)
-                pass 
+            elif tech.startswith('10xv'): 
+                size = pd.to_numeric(df['size'], errors='coerce')
+                for (row, rsize) in zip(df.itertuples(), size):
+                    if row.run_id in self.aligned.itemset:
+                        continue
+                    jobs.append(AlignJob(self.srpid, [row.run_id], rsize, self._run_star_10x, 
+                                         row.run_id, tech, row.read1, row.read2, row.nreads))
             else :
                 self.log.debug(
                     f'{tech} is not yet supported for STAR alignment.')
                 # log... technology not yet supported
                 pass
+        return jobs
+
+    def _align_smartseq(self, df, nthreads=None):
+        # build the manifest
+        (manipath, manifest, stream) = self._make_manifest(df) 
+        if len(manifest) == 0:
+            self.log.warning(f'no readable smartseq runs for {self.srpid}')
+            return False
+        # run star
+        return self._run_star_smartseq(manipath, manifest, stream, nthreads)
 
 
     # TODO  make a run|taxon|tech|read1|read2|batch  dataframe in impute. 
@@ -114,49 +431,141 @@ class AlignReads(object):
         
         # sdf = pd.read_csv(f'{metadir}/samples.tsv',sep="\t" ,index_col=0)
         # edf = pd.read_csv(f'{metadir}/experiments.tsv',sep="\t" ,index_col=0)
-        rdf = pd.read_csv(f'{self.metadir}/runs.tsv',sep="\t" ,index_col=0)
+        # only rows for requested project id
+        rdf = self.store.read('runs', proj_id=self.srpid)
         
-        # TODO from imputation - df containing runs with corresponding tech
-        run2tech = pd.read_csv(f'{self.metadir}/run2tech.tsv',sep="\t" ,index_col=0)
-        run2tech.columns = ["run_id","tech"]
-        # filter to include only requested project id
-        rdf = rdf.loc[ rdf.proj_id==self.srpid ,:]
+        # from imputation - df containing runs with corresponding tech
+        run2tech = self.store.read('impute', proj_id=self.srpid)
+        run2tech = run2tech[['run_id', 'tech_version', 'read1', 'read2']]
+        run2tech.columns = ["run_id","tech", "read1", "read2"]
         # filter to include only requested species and only keep run ids
-        rdf = rdf.loc[ rdf.taxon == int(spec_to_taxon(self.species)) ,['run_id','nreads']]
+        rdf = rdf.loc[ rdf.taxon == int(spec_to_taxon(self.species)) ,['run_id','nreads','tot_spots','size']]
 
-        rdf = pd.merge(rdf, run2tech , how = 'left', on = "run_id") 
+        rdf = pd.merge(rdf, run2tech , how = 'inner', on = "run_id") 
 
         return (rdf)
 
+    def _start_stream(self, name, runs, used):
+        '''
+        Start dumping runs [(srrid, nreads)] into named pipes under tempdir. 
+        '''
+        fifodir = f'{self.tempdir}/{name}.fifo'
+        stream = FastqDumpStream(self.config, runs, fifodir, used)
+        stream.start()
+        return stream
+
+    def _read_files_command(self, stream=None):
+        if stream is None and self.fastq_ext == '.gz':
+            return ['--readFilesCommand', 'zcat']
+        return []
+
+    def _run_star(self, cmd, stream=None):
+        '''
+        Run STAR. With a stream, the run only counts if the dump completed too, 
+        since STAR can't tell a truncated stream from the end of the reads. 
+        '''
+        genome = None
+        if self.genomeload == 'shared':
+            genome = get_shared_genome(self.genomedir, self.tempdir)
+            if genome.acquire():
+                cmd = cmd + ['--genomeLoad', 'LoadAndKeep']
+            else:
+                genome = None
+        cmdstr = " ".join(cmd)
+        self.log.debug(f"STAR command: {cmdstr} running...")
+        try:
+            cp = subprocess.run(cmd)
+            rc = cp.returncode
+        except OSError as ex:
+            self.log.error(f'unable to run STAR: {ex}')
+            rc = -1
+        finally:
+            if genome is not None:
+                genome.release()
+        self.log.debug(f"Ran cmd='{cmdstr}' returncode={rc} {type(rc)} ")
+        ok = str(rc) == "0"
+        if stream is not None:
+            if not ok:
+                stream.abort()
+            if not stream.wait():
+                self.log.warning(f'fastq-dump stream incomplete for {cmdstr}')
+                ok = False
+            stream.cleanup()
+        return ok
+
     # smart seq scripts
     def _make_manifest(self,run_data):
-        # search for all fastq files with <run>_[0-9].fastq
+        '''
+        In file mode, fastq files <run>_[0-9].fastq are found with one scan of cachedir. 
+        In stream mode, manifest points at the named pipes, and the stream is started.
+        Runs with an unknown read count can't be streamed, and are left out with a warning.
+        Returns (manipath, manifest, stream or None)
+        '''
         manipath = f"{self.metadir}/{self.srpid}_smartseq_manifest.tsv"
 
         # runid = runlist[1]
         allRows = []
-        for runid in run_data.run_id:
-            # where are the fastq files? In temp
-            fqs = glob.glob(f'{self.tempdir}/{runid}*.fastq')
-            fqs.sort()
-            # number of fastq files found for the run
-            if len(fqs) > 0 and len(fqs) < 3:
+        stream = None
+        if self.readmode == 'stream':
+            nreads = pd.to_numeric(run_data.nreads, errors='coerce')
+            for runid in run_data.run_id[nreads.isna()]:
+                self.log.warning(f'read count unknown for {runid}. not streaming it.')
+            runs = [(runid, int(n)) for (runid, n) in zip(run_data.run_id, nreads) if not pd.isna(n)]
+            if len(runs) == 0:
+                return (manipath, pd.DataFrame([], columns=['read1', 'read2', 'run']), None)
+            used = set()
+            for (runid, nreads) in runs:
+                fqs = [f'{runid}_{i + 1}.fastq' for i in range(min(nreads, 2))]
+                used.update(fqs)
+                fqs = [f'{self.tempdir}/{self.srpid}_smartseq.fifo/{fq}' for fq in fqs]
                 if len(fqs) == 1:
                     fqs.append('-')
-                    fqs.append(runid)
-                elif len(fqs) == 2:
-                    fqs.append(runid)
-
+                fqs.append(runid)
                 allRows.append(fqs)
+            stream = self._start_stream(f'{self.srpid}_smartseq', runs, used)
+        else:
+            cached = self._scan_fastqs()
+            for (runid, nreads) in zip(run_data.run_id, run_data.nreads):
+                # where are the fastq files? In cache, dump them if not there yet. 
+                fqs = cached.get(runid, [])
+                if len(fqs) == 0:
+                    nreads = None if pd.isna(nreads) else int(nreads)
+                    FasterqDump(self.config, runid, [], nreads, self.srpid).execute()
+                    fqs = glob.glob(f'{self.cachedir}/{runid}_*.fastq{self.fastq_ext}')
+                fqs.sort()
+                for fq in fqs:
+                    self.cache.touch(fq)
+                # number of fastq files found for the run
+                if len(fqs) > 0 and len(fqs) < 3:
+                    if len(fqs) == 1:
+                        fqs.append('-')
+                        fqs.append(runid)
+                    elif len(fqs) == 2:
+                        fqs.append(runid)
+
+                    allRows.append(fqs)
 
         manifest = pd.DataFrame(allRows, columns=['read1', 'read2', 'run'])
 
         # overwrite
         manifest.to_csv(manipath, sep="\t", header=None, index=False, mode="w")
 
-        return(manipath, manifest)
+        return(manipath, manifest, stream)
 
-    def _run_star_smartseq(self,manifest,manipath):
+    def _scan_fastqs(self):
+        '''
+        {run_id: [fastq paths]} for <run>_<n>.fastq[.gz] in cachedir, from a single listing. 
+        '''
+        pattern = re.compile(r'^(.+)_[0-9]\.fastq' + re.escape(self.fastq_ext) + '$')
+        cached = {}
+        with os.scandir(self.cachedir) as it:
+            for entry in it:
+                m = pattern.match(entry.name)
+                if m is not None:
+                    cached.setdefault(m.group(1), []).append(entry.path)
+        return cached
+
+    def _run_star_smartseq(self, manipath, manifest, stream=None, nthreads=None):
 
         ss_params = {"solo_type": "SmartSeq",
                      "soloUMIdedup": "Exact",
@@ -186,26 +595,24 @@ class AlignReads(object):
         out_file_prefix = f'{self.outputdir}/{self.srpid}_smartseq_'
         cmd = ['STAR',
                '--runMode', 'alignReads',
-               '--runThreadN', f'{self.num_streams}',
-               '--genomeDir', f'{self.resourcedir}/genomes/{self.species}/STAR_index',
+               '--runThreadN', f'{nthreads or self.ncore_align}',
+               '--genomeDir', self.genomedir,
                '--outFileNamePrefix', out_file_prefix,
                '--soloType', ss_params["solo_type"],
                '--soloFeatures', 'Gene',
                '--readFilesManifest', f'{manipath}',
                '--soloUMIdedup', ss_params["soloUMIdedup"],
                '--soloStrand', ss_params["soloStrand"],
-               '--outSAMtype', 'None']
-
-        cmdstr = " ".join(cmd)
+               '--outSAMtype', 'None'] + self._read_files_command(stream)
 
-        logging.debug(f"STAR command: {cmdstr} running...")
-        cp = subprocess.run(cmd)
-
-        logging.debug(
-            f"Ran cmd='{cmdstr}' returncode={cp.returncode} {type(cp.returncode)} ")
         # successful runs - append to outlist.
-        if str(cp.returncode) == "0":
-            self.outlist.append(self.srrid)
+        ok = self._run_star(cmd, stream)
+        if ok:
+            self.outlist.extend(manifest.run)
+            self.aligned.append(list(manifest.run))
+            for runid in manifest.run:
+                self.cache.consumed(runid, 'analysis')
+        return ok
 
         # # did we write to a temp directory?
         # if out_file_prefix.startswith(f'{self.tempdir}'):
@@ -244,16 +651,36 @@ class AlignReads(object):
         return(d[tech])
    
     # impute stage will obtain tech, and bio/tech_readpaths for 10x runs
-    def _run_star_10x(self,srrid, tech, bio_readpath,tech_readpath):
+    def _run_star_10x(self,srrid, tech, bio_readpath,tech_readpath, nreads=2, nthreads=None):
 
         # read_bio, read_tech, tech = self._impute_10x_version()
         # ideally, which read is which will be obtained from impute stage
         star_param = self._get_10x_STAR_parameters(tech)  # as dictionary
+        # 10x runs have at least cDNA and barcode reads
+        nreads = 2 if pd.isna(nreads) else int(nreads)
+
+        stream = None
+        if self.readmode == 'stream':
+            stream = self._start_stream(srrid, [(srrid, nreads)], 
+                                        [bio_readpath, tech_readpath])
+            readdir = stream.fifodir
+        else:
+            if not os.path.exists(f'{self.cachedir}/{bio_readpath}{self.fastq_ext}'):
+                dumped = []
+                FasterqDump(self.config, srrid, dumped, nreads, self.srpid).execute()
+                if len(dumped) == 0:
+                    self.log.warning(f'unable to dump fastq for {srrid}')
+                    return False
+            readdir = self.cachedir
+            bio_readpath = f'{bio_readpath}{self.fastq_ext}'
+            tech_readpath = f'{tech_readpath}{self.fastq_ext}'
+            for fq in [bio_readpath, tech_readpath]:
+                self.cache.touch(f'{readdir}/{fq}')
 
         cmd = ['STAR',
                 '--runMode', 'alignReads',
-                '--runThreadN', f'{self.ncore_align}',
-                '--genomeDir', f'{self.resourcedir}/genomes/{self.species}/STAR_index',
+                '--runThreadN', f'{nthreads or self.ncore_align}',
+                '--genomeDir', self.genomedir,
                 '--outFileNamePrefix', f'{self.outputdir}/{srrid}_{tech}_',
                 '--soloType', star_param["solo_type"],
                 '--soloCBwhitelist', star_param["white_list_path"],
@@ -261,19 +688,17 @@ class AlignReads(object):
                 '--soloUMIstart', f'{int(star_param["CB_length"]) + 1}',
                 '--soloUMIlen', star_param["UMI_length"],
                 '--soloFeatures', 'Gene',
-                '--readFilesIn', bio_readpath, tech_readpath,
-                '--outSAMtype', 'None']
-
-        cp = subprocess.run(cmd)
+                '--readFilesIn', f'{readdir}/{bio_readpath}', f'{readdir}/{tech_readpath}',
+                '--outSAMtype', 'None'] + self._read_files_command(stream)
 
-        cmdstr = " ".join(cmd)
-        logging.debug(f"Fasterq-dump command: {cmdstr} running...")
-        cp = subprocess.run(cmd)
-        logging.debug(
-            f"Ran cmd='{cmdstr}' returncode={cp.returncode} {type(cp.returncode)} ")
         # successful runs - append to outlist.
-        if str(cp.returncode) == "0":
-            self.outlist.append(self.srrid)
+        ok = self._run_star(cmd, stream)
+        if ok:
+            self.outlist.append(srrid)
+            self.aligned.append([srrid])
+            self.cache.consumed(srrid, 'analysis')
+        return ok
+
 
  
 
@@ -1,15 +1,53 @@
 import gzip
+import importlib
 import os
 import logging
 import shutil
+import struct
+import sys
 import tempfile
 import traceback
-import urllib
-import numpy as np
-from scipy import sparse
-from ftplib import FTP
+import urllib.parse
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-import pandas as pd
+
+class LazyModule(object):
+    '''
+    Stand-in for a heavy module (pandas, scipy, scanpy...), imported on first attribute 
+    access. Entry points that never touch it (e.g. sra.py --uidquery, the query daemon) 
+    don't pay its import time. 
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # only called for attributes not yet cached on the instance.
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return f'<lazy module {self._name}>'
+
+
+def lazy_import(name):
+    '''
+    Module name if already imported, otherwise a LazyModule for it. 
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+sparse = lazy_import('scipy.sparse')
 
 
 def readlist(filepath):
@@ -56,6 +94,97 @@ def writelist(filepath, dlist):
         pass
 
 
+class TrackedList(object):
+    '''
+    In-memory mirror of a one-item-per-line list file (todo/done lists). 
+
+    refresh() reads only the bytes appended since the last check. If the file was 
+    replaced (new inode, e.g. writelist rename) or truncated, it is re-read in full. 
+    A trailing partial line (writer crashed mid-append) is left for the next refresh. 
+
+    append() adds new items with a single O_APPEND write, so no full rewrite per batch. 
+    compact() rewrites the file sorted via writelist (temp + rename), once enough 
+    unsorted appends have accumulated. 
+    '''
+
+    def __init__(self, filepath, compact_min=1000, compact_frac=0.1):
+        self.log = logging.getLogger('utils')
+        self.filepath = filepath
+        self.compact_min = compact_min
+        self.compact_frac = compact_frac
+        self.appended = 0
+        self._reset(None)
+
+    def _reset(self, inode):
+        self.items = []
+        self.itemset = set()
+        self.inode = inode
+        self.offset = 0
+
+    def _add(self, item):
+        if item not in self.itemset:
+            self.itemset.add(item)
+            self.items.append(item)
+
+    def refresh(self):
+        if self.filepath is None:
+            return self.items
+        try:
+            f = open(self.filepath, 'rb')
+        except FileNotFoundError:
+            self._reset(None)
+            return self.items
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                logging.debug(f're-reading whole file: {self.filepath}')
+                self._reset(st.st_ino)
+            if st.st_size > self.offset:
+                f.seek(self.offset)
+                data = f.read(st.st_size - self.offset)
+                end = data.rfind(b'\n') + 1
+                for line in data[:end].decode().splitlines():
+                    line = line.strip()
+                    if len(line) > 0:
+                        self._add(line)
+                self.offset += end
+        logging.debug(f'{self.filepath} has {len(self.items)} items.')
+        return self.items
+
+    def append(self, newitems):
+        newitems = [i for i in newitems if i not in self.itemset]
+        if len(newitems) == 0 or self.filepath is None:
+            return
+        data = "".join([f"{item}\n" for item in newitems])
+        fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size > 0:
+                with open(self.filepath, 'rb') as f:
+                    f.seek(size - 1)
+                    if f.read(1) != b'\n':
+                        data = "\n" + data
+            os.write(fd, data.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.appended += len(newitems)
+        # picked up (and deduplicated) by the next refresh. 
+        for item in newitems:
+            self._add(item)
+        logging.info(f"appended {len(newitems)} to {self.filepath}")
+
+    def compact(self, force=False):
+        limit = max(self.compact_min, int(len(self.items) * self.compact_frac))
+        if self.filepath is None or (not force and self.appended < limit):
+            return
+        self.refresh()
+        writelist(self.filepath, sorted(self.items))
+        self.appended = 0
+        self._reset(None)
+        self.refresh()
+
+
 def merge_write_df(newdf, filepath):
     """
     Reads existing, merges new, drops duplicates, writes to temp, renames temp. 
@@ -123,6 +252,7 @@ def download_ftpurl(srcurl, destpath, finalname=None, overwrite=True, decompress
     dirname = os.path.dirname(fullpath)
     log.info(
         f"Downloading file {filename} at path {dirname}/ on host {host} via FTP.")
+    from ftplib import FTP
     ftp = FTP(host)
     ftp.login('anonymous', 'hover@cshl.edu')
     ftp.cwd(dirname)
@@ -163,6 +293,78 @@ def gzip_decompress(filename):
             f'tried to gunzip file without .gz extension {filename}. doing nothing.')
 
 
+# BGZF: gzip members of <= 64KB with the block size in a 'BC' extra field, as bgzip writes.
+# Any gzip reader (zcat, STAR --readFilesCommand zcat) reads it as one stream.
+BGZF_BLOCKSIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def bgzf_block(data, level=6):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    # BSIZE is total block length - 1: 18 header + cdata + 8 footer
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff,
+                         6, ord('B'), ord('C'), 2, len(cdata) + 25)
+    footer = struct.pack('<II', zlib.crc32(data), len(data))
+    return header + cdata + footer
+
+
+class BgzfWriter(object):
+    '''
+    Writes a BGZF (multi-member gzip) file, compressing blocks on <threads> threads. 
+    zlib releases the GIL, so blocks really compress in parallel. Blocks are written 
+    in order, with at most threads * 4 outstanding. 
+    '''
+
+    def __init__(self, filepath, threads=4, level=6):
+        self.filepath = filepath
+        self.level = level
+        self.f = open(filepath, 'wb')
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.maxpending = threads * 4
+        self.pending = deque()
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= BGZF_BLOCKSIZE:
+            self._submit(bytes(self.buf[:BGZF_BLOCKSIZE]))
+            del self.buf[:BGZF_BLOCKSIZE]
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(bgzf_block, block, self.level))
+        while len(self.pending) > self.maxpending:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if len(self.buf) > 0:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while len(self.pending) > 0:
+            self.f.write(self.pending.popleft().result())
+        self.f.write(BGZF_EOF)
+        self.f.close()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def bgzf_compress(src, destpath, threads=4, level=6, bufferlength=4 * 1024 * 1024):
+    '''
+    Copy src (path, or binary file object such as a named pipe) to BGZF destpath. 
+    '''
+    if isinstance(src, str):
+        with open(src, 'rb') as f_in:
+            return bgzf_compress(f_in, destpath, threads, level, bufferlength)
+    with BgzfWriter(destpath, threads, level) as f_out:
+        for data in iter(lambda: src.read(bufferlength), b''):
+            f_out.write(data)
+
+
 def gini_coefficient(x):
     """Compute Gini coefficient of array of values"""
     diffsum = 0
@@ -171,27 +373,50 @@ def gini_coefficient(x):
     return diffsum / (len(x)**2 * np.mean(x))
 
 
-def gini_coefficient_spmat(x):
+def gini_coefficient_spmat(x, nprocs=1, chunkrows=None):
     """ 
         Compute Gini coefficient for expression matrix
-        Assumes x is a cell x gene matrix
-        expected time ~ 10 min for 55000 genes 
+        Assumes x is a cell x gene matrix (CSR, CSC or dense)
+        Returns 1-d array, one per cell. NaN for cells with no counts. 
+
+        Uses the closed form over sorted values, sum_{i<j} |y_i - y_j| = sum_k (2k - n - 1) y_k, 
+        with each row's nonzeros sorted once and its zeros placed implicitly, 
+        O(nnz log nnz) overall. 
+        With nprocs > 1, blocks of chunkrows cells are done in separate processes. 
     """
-    diffsum = 0
-    # XXX loop is slow! Can be parallelized if speed is desired.
-    for i in range(x.shape[1]):
-        xi = x[:,i]
-        rem = x[:,i:]
-        # make xi the correct size. Broadcasting doesn't work for sparse matrices
-        n = rem.shape[1]
-        diffsum += np.sum(np.abs(xi[:,np.zeros(n)] - rem) ,axis=1)
-        # if i%1000 ==0 :
-        #     print(i) 
-       
-    return diffsum / (x.shape[1]**2 * np.mean(x,axis=1))
-
-
-def sparse_pairwise_corr(A, B=None):
+    x = sparse.csr_matrix(x)
+    if nprocs <= 1 or x.shape[0] < 2:
+        return _gini_csr(x)
+    if chunkrows is None:
+        chunkrows = int(np.ceil(x.shape[0] / nprocs))
+    chunks = [x[i:i + chunkrows] for i in range(0, x.shape[0], chunkrows)]
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        return np.concatenate(list(pool.map(_gini_csr, chunks)))
+
+
+def _gini_csr(x):
+    """
+    Row Gini coefficients of CSR matrix x. See gini_coefficient_spmat
+    """
+    (nrows, n) = x.shape
+    # copy, sorted in place within each row. much faster than one global lexsort.
+    data = x.data.astype(np.float64)
+    for (start, end) in zip(x.indptr[:-1], x.indptr[1:]):
+        data[start:end].sort()
+    rowlen = np.diff(x.indptr)
+    rows = np.repeat(np.arange(nrows), rowlen)
+    # 1-based rank among all n values of the row. zeros sit below positive values.
+    pos = np.arange(len(data)) - x.indptr[rows]
+    nzeros = (n - rowlen)[rows]
+    rank = pos + 1 + np.where(data > 0, nzeros, 0)
+    diffsum = np.bincount(rows, weights=(2 * rank - n - 1) * data, minlength=nrows)
+    rowsum = np.bincount(rows, weights=data, minlength=nrows)
+    # diffsum / (n**2 * mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return diffsum / (n * rowsum)
+
+
+def sparse_pairwise_corr(A, B=None, blocksize=None, out=None):
     """
     Compute pairwise correlation for sparse matrices. 
     Currently only implements pearson correlation.
@@ -202,6 +427,10 @@ def sparse_pairwise_corr(A, B=None):
         elements in A with elements in B
     and main diagonal blocks as correlations between
         elements in A (or B) with elements in A (or B)
+
+    With blocksize, rows are done blocksize at a time straight into the result 
+    (or into out, e.g. an np.memmap), so only one dense N+M x N+M array is ever held. 
+    For correlations against a single vector use sparse_corr_to_vector. 
     """
 
     if B is not None:
@@ -210,6 +439,9 @@ def sparse_pairwise_corr(A, B=None):
     A = A.astype(np.float64)
     n = A.shape[1]
 
+    if blocksize is not None:
+        return _sparse_pairwise_corr_blocked(sparse.csr_matrix(A), int(blocksize), out)
+
     # Compute the covariance matrix
     rowsum = A.sum(1)
     centering = rowsum.dot(rowsum.T.conjugate()) / n
@@ -223,6 +455,42 @@ def sparse_pairwise_corr(A, B=None):
     return coeffs
 
 
+def _sparse_pairwise_corr_blocked(A, blocksize, out=None):
+    (N, n) = A.shape
+    rowsum = np.asarray(A.sum(1)).ravel()
+    sqsum = np.asarray(A.multiply(A).sum(1)).ravel()
+    # std * sqrt(n - 1), the (n - 1) cancels
+    norm = np.sqrt(sqsum - rowsum**2 / n)
+    AT = A.T.tocsc()
+    if out is None:
+        out = np.empty((N, N))
+    for i in range(0, N, blocksize):
+        j = min(N, i + blocksize)
+        C = (A[i:j] @ AT).toarray() - np.outer(rowsum[i:j], rowsum) / n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[i:j] = C / np.outer(norm[i:j], norm)
+    return out
+
+
+def sparse_corr_to_vector(X, v):
+    """
+    Pearson correlation of each row of X (N x P, sparse or dense) with vector v (length P). 
+    O(nnz) memory, no N x N matrix. Returns 1-d array, NaN for constant rows. 
+    Same values as sparse_pairwise_corr(v, X)[0, 1:]
+    """
+    X = sparse.csr_matrix(X, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64).ravel()
+    n = X.shape[1]
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    rowsum = np.bincount(rows, weights=X.data, minlength=X.shape[0])
+    sqsum = np.bincount(rows, weights=X.data**2, minlength=X.shape[0])
+    vsum = v.sum()
+    cov = X @ v - rowsum * vsum / n
+    xnorm = np.sqrt(sqsum - rowsum**2 / n)
+    vnorm = np.sqrt(v @ v - vsum**2 / n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cov / (xnorm * vnorm)
+
 
 def taxon_to_spec(taxid= '10090'):
     d = {   '10090': "mouse",
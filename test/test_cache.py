@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+#  Cache budget: reserve() and the download stage when the budget is small.
+#
+#   python -m unittest discover -s test          from the repo root.
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from configparser import ConfigParser
+from unittest import mock
+
+gitpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(gitpath)
+
+from scqc import core, sra
+from scqc.cache import CacheManager, GB
+
+
+def make_config(rootdir, budget, wait=5):
+    config = ConfigParser()
+    config.read(f'{gitpath}/etc/scqc.conf')
+    config.set('DEFAULT', 'rootdir', rootdir)
+    config.set('DEFAULT', 'cache_budget_gb', repr(budget / GB))
+    config.set('DEFAULT', 'cache_wait', str(wait))
+    config.set('DEFAULT', 'pollinterval', '0.05')
+    for d in ['cache', 'metadata', 'temp']:
+        os.makedirs(f'{rootdir}/{d}', exist_ok=True)
+    return config
+
+
+class TestReserve(unittest.TestCase):
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def artifact(self, cache, name, size, proj_id):
+        path = f'{cache.cachedir}/{name}.sra'
+        with open(path, 'wb') as f:
+            f.write(bytes(size))
+        cache.register(path, 'download', 'analysis', name, proj_id)
+
+    def test_fits(self):
+        cache = CacheManager(make_config(self.rootdir, 10000))
+        self.assertTrue(cache.reserve(5000))
+        self.assertEqual(cache.reserved, 5000)
+
+    def test_own_batch_defers(self):
+        # only the batch's own unconsumed files could make room: don't wait for them.
+        cache = CacheManager(make_config(self.rootdir, 10000, wait=60))
+        self.artifact(cache, 'R1', 8000, 'P1')
+        start = time.time()
+        self.assertFalse(cache.reserve(5000, exclude={'P1'}))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(cache.reserved, 0)
+
+    def test_waits_for_consumer(self):
+        cache = CacheManager(make_config(self.rootdir, 10000, wait=60))
+        self.artifact(cache, 'R0', 8000, 'P0')
+        t = threading.Timer(0.3, cache.consumed, args=('R0', 'analysis'))
+        t.start()
+        self.assertTrue(cache.reserve(5000, exclude={'P1'}))
+        t.join()
+        self.assertFalse(os.path.exists(f'{cache.cachedir}/R0.sra'))
+
+    def test_wait_times_out(self):
+        cache = CacheManager(make_config(self.rootdir, 10000, wait=0.3))
+        self.artifact(cache, 'R0', 8000, 'P0')
+        self.assertFalse(cache.reserve(5000, exclude={'P1'}))
+
+    def test_force(self):
+        cache = CacheManager(make_config(self.rootdir, 10000))
+        self.artifact(cache, 'R1', 8000, 'P1')
+        self.assertTrue(cache.reserve(5000, exclude={'P1'}, force=True))
+
+
+def fake_fetch(run):
+    with open(f'{run.sracache}/{run.runid}.sra', 'wb') as f:
+        f.write(bytes(run.size))
+    run.outlist.append(run.runid)
+
+
+class TestDownloadBudget(unittest.TestCase):
+    '''
+    Download stage with fetches faked: each run writes <size> bytes to cachedir.
+    '''
+
+    RUNS = {'P1': {'R11': 3000, 'R12': 3000, 'R13': 3000},
+            'P2': {'R21': 3000, 'R22': 3000}}
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch('scqc.cache._managers', {}),
+            mock.patch.object(sra, 'get_runs_for_project',
+                              lambda config, p, screen=False: list(self.RUNS[p])),
+            mock.patch.object(sra, 'get_run_urls', lambda config, p: {}),
+            mock.patch.object(sra, 'get_run_sizes', lambda config, p: dict(self.RUNS[p])),
+            mock.patch.object(sra.DownloadRun, '_fetch', fake_fetch),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        shutil.rmtree(self.rootdir)
+
+    def execute(self, config, dolist):
+        done = []
+        t = threading.Thread(target=lambda: done.extend(core.Download(config).execute(dolist)),
+                             daemon=True)
+        t.start()
+        t.join(30)
+        self.assertFalse(t.is_alive(), 'download stage hung')
+        return done
+
+    def test_project_over_budget(self):
+        # 9000 bytes of runs, 8000 byte budget: can never fit, so it isn't waited for.
+        config = make_config(self.rootdir, 8000, wait=60)
+        self.assertEqual(self.execute(config, ['P1']), ['P1'])
+
+    def test_batch_over_budget(self):
+        # each project fits, both together don't. one is deferred, not waited for.
+        config = make_config(self.rootdir, 10000, wait=60)
+        done = self.execute(config, ['P1', 'P2'])
+        self.assertEqual(len(done), 1)
+        # analysis consumes what was done, the deferred project completes next cycle.
+        cache = core.get_cache(config)
+        for runid in self.RUNS[done[0]]:
+            cache.consumed(runid, 'analysis')
+        left = [p for p in ['P1', 'P2'] if p not in done]
+        self.assertEqual(self.execute(config, left), left)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+#  RangeDownloader resume and verify paths against a local range server, and
+#  DownloadScheduler accounting.
+#
+#   python -m unittest discover -s test          from the repo root.
+#
+
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+gitpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(gitpath)
+
+from scqc.download import RangeDownloader, DownloadScheduler, DownloadVerifyException
+
+CHUNK = 64 * 1024
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    Serves server.blob with range support. While server.corrupt > 0, range replies
+    are zeroed (and corrupt is decremented). Range GETs are recorded in server.ranges.
+    '''
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.blob)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        blob = self.server.blob
+        (a, b) = map(int, re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups())
+        data = blob[a:b + 1]
+        with self.server.lock:
+            self.server.ranges.append(a)
+            if self.server.corrupt > 0:
+                self.server.corrupt -= 1
+                data = bytes(len(data))
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {a}-{b}/{len(blob)}')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRangeDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.httpd.blob = os.urandom(5 * CHUNK + 1234)
+        self.httpd.lock = threading.Lock()
+        self.httpd.ranges = []
+        self.httpd.corrupt = 0
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/run.sra'
+        self.outfile = f'{self.tmpdir}/run.sra'
+        self.md5 = hashlib.md5(self.httpd.blob).hexdigest()
+        self.dl = RangeDownloader(chunksize=CHUNK, streams=2, backoff=0.01)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def assertGood(self):
+        with open(self.outfile, 'rb') as f:
+            self.assertEqual(f.read(), self.httpd.blob)
+        self.assertFalse(os.path.exists(f'{self.outfile}.part'))
+        self.assertFalse(os.path.exists(f'{self.outfile}.journal'))
+
+    def test_fetch(self):
+        self.dl.fetch(self.url, self.outfile, md5=self.md5, size=len(self.httpd.blob))
+        self.assertGood()
+        self.assertEqual(len(self.httpd.ranges), 6)
+
+    def test_md5_failure_restarts(self):
+        self.httpd.corrupt = 1
+        with self.assertRaises(DownloadVerifyException):
+            self.dl.fetch(self.url, self.outfile, md5=self.md5)
+        self.assertFalse(os.path.exists(f'{self.outfile}.part'))
+        self.assertFalse(os.path.exists(f'{self.outfile}.journal'))
+        # retry downloads every chunk again rather than trusting the old journal.
+        self.httpd.ranges = []
+        self.dl.fetch(self.url, self.outfile, md5=self.md5)
+        self.assertGood()
+        self.assertEqual(len(self.httpd.ranges), 6)
+
+    def test_resume(self):
+        # interrupted after chunks 0 and 2.
+        blob = self.httpd.blob
+        with open(f'{self.outfile}.part', 'wb') as f:
+            f.write(blob[:CHUNK] + bytes(CHUNK) + blob[2 * CHUNK:3 * CHUNK] +
+                    bytes(len(blob) - 3 * CHUNK))
+        with open(f'{self.outfile}.journal', 'w') as f:
+            f.write(f'# size={len(blob)} chunksize={CHUNK}\n0\n2\n')
+        self.dl.fetch(self.url, self.outfile, md5=self.md5)
+        self.assertGood()
+        self.assertEqual(sorted(self.httpd.ranges), [CHUNK, 3 * CHUNK, 4 * CHUNK, 5 * CHUNK])
+
+    def test_journal_without_partfile(self):
+        blob = self.httpd.blob
+        with open(f'{self.outfile}.journal', 'w') as f:
+            f.write(f'# size={len(blob)} chunksize={CHUNK}\n')
+            f.write(''.join(f'{i}\n' for i in range(6)))
+        self.dl.fetch(self.url, self.outfile, md5=self.md5)
+        self.assertGood()
+        self.assertEqual(len(self.httpd.ranges), 6)
+
+    def test_journal_with_short_partfile(self):
+        blob = self.httpd.blob
+        with open(f'{self.outfile}.part', 'wb') as f:
+            f.write(blob[:CHUNK])
+        with open(f'{self.outfile}.journal', 'w') as f:
+            f.write(f'# size={len(blob)} chunksize={CHUNK}\n0\n1\n')
+        self.dl.fetch(self.url, self.outfile, md5=self.md5)
+        self.assertGood()
+        self.assertEqual(len(self.httpd.ranges), 6)
+
+    def test_metadata_size(self):
+        n = len(self.httpd.blob)
+        with self.assertRaises(DownloadVerifyException):
+            self.dl.fetch(self.url, self.outfile, size=n + 5000)
+        self.assertEqual(self.httpd.ranges, [])
+        # e.g. size from runinfo size_MB, rounded.
+        self.dl.fetch(self.url, self.outfile, md5=self.md5, size=n + 5000, slack=10000)
+        self.assertGood()
+
+
+class FakeJob(object):
+
+    def __init__(self, proj_id, size, nbytes):
+        self.proj_id = proj_id
+        self.size = size
+        self.nbytes = nbytes
+
+    def execute(self):
+        if isinstance(self.nbytes, Exception):
+            raise self.nbytes
+        return self.nbytes
+
+
+class TestDownloadScheduler(unittest.TestCase):
+
+    def test_only_successes_count(self):
+        ds = DownloadScheduler(max_jobs=2)
+        ds.add(FakeJob('P1', 1000, 1000))
+        # failed without raising (e.g. prefetch fallback failed too), and raised.
+        ds.add(FakeJob('P1', 5000, 0))
+        ds.add(FakeJob('P2', 7000, IOError('boom')))
+        ds.run()
+        self.assertEqual(ds.done_bytes, 1000)
+        self.assertEqual(ds.remaining, {'P1': 0, 'P2': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+#  EUtilsClient against a local stub HTTP server.
+#
+#   python -m unittest discover -s test          from the repo root.
+#
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+gitpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(gitpath)
+
+from scqc import eutils
+from scqc.eutils import EUtilsClient, TokenBucket
+
+RUNINFO = b'Run,ReleaseDate,spots,bases\nSRR000001,2020-01-01,100,5000\nSRR000002,2020-01-01,200,10000\n'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Replies from server.script[path]: a list of (code, headers, body), one per hit.
+    The last entry repeats. Every hit is recorded as (path, time).
+    '''
+
+    def _reply(self):
+        path = self.path.split('?')[0]
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            self.rfile.read(length)
+        with self.server.lock:
+            self.server.hits.append((path, time.monotonic()))
+            script = self.server.script.get(path, [(404, {}, b'')])
+            (code, headers, body) = script[0]
+            if len(script) > 1:
+                script.pop(0)
+        self.send_response(code)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _reply
+    do_POST = _reply
+    do_PUT = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(object):
+
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.lock = threading.Lock()
+        self.httpd.hits = []
+        self.httpd.script = {}
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def script(self, path, replies):
+        self.httpd.script[path] = list(replies)
+
+    def hits(self, path):
+        return [t for (p, t) in self.httpd.hits if p == path]
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_config(**kwargs):
+    config = ConfigParser()
+    config.add_section('sra')
+    for (k, v) in kwargs.items():
+        config.set('sra', k, str(v))
+    return config
+
+
+class TestEUtilsClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_retry_after(self):
+        self.server.script('/ra', [(429, {'Retry-After': '1'}, b''), (200, {}, b'ok')])
+        client = EUtilsClient(make_config(max_rate=100, backoff=0.01))
+        start = time.monotonic()
+        r = client.get(f'{self.server.url}/ra')
+        took = time.monotonic() - start
+        client.close()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'ok')
+        hits = self.server.hits('/ra')
+        self.assertEqual(len(hits), 2)
+        # Retry-After wins over the (much shorter) backoff.
+        self.assertGreaterEqual(hits[1] - hits[0], 0.9)
+        self.assertGreaterEqual(took, 0.9)
+
+    def test_5xx_retries(self):
+        self.server.script('/5xx', [(503, {}, b''), (502, {}, b''), (500, {}, b''),
+                                    (200, {}, b'ok')])
+        client = EUtilsClient(make_config(max_rate=100, backoff=0.01, max_tries=5))
+        r = client.post(f'{self.server.url}/5xx')
+        client.close()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(self.server.hits('/5xx')), 4)
+
+    def test_5xx_give_up(self):
+        self.server.script('/down', [(503, {}, b'')])
+        client = EUtilsClient(make_config(max_rate=100, backoff=0.01, max_tries=3))
+        r = client.get(f'{self.server.url}/down')
+        client.close()
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(len(self.server.hits('/down')), 3)
+
+    def test_not_retried(self):
+        self.server.script('/gone', [(404, {}, b'')])
+        client = EUtilsClient(make_config(max_rate=100, backoff=0.01))
+        r = client.get(f'{self.server.url}/gone')
+        client.close()
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(len(self.server.hits('/gone')), 1)
+
+    def test_rate(self):
+        rate = 10
+        n = 11
+        self.server.script('/rate', [(200, {}, b'ok')])
+        client = EUtilsClient(make_config(max_rate=rate, max_inflight=4))
+        threads = [threading.Thread(target=client.get, args=(f'{self.server.url}/rate',))
+                   for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        client.close()
+        hits = sorted(self.server.hits('/rate'))
+        self.assertEqual(len(hits), n)
+        # one token up front, then <rate> per second.
+        self.assertGreaterEqual(hits[-1] - hits[0], (n - 1) / rate * 0.9)
+
+    def test_rate_async(self):
+        rate = 10
+        n = 11
+        self.server.script('/arate', [(200, {}, b'ok')])
+        client = EUtilsClient(make_config(max_rate=rate, max_inflight=4))
+        rs = client.gather('GET', [f'{self.server.url}/arate'] * n)
+        client.close()
+        self.assertEqual([r.status_code for r in rs], [200] * n)
+        hits = sorted(self.server.hits('/arate'))
+        self.assertGreaterEqual(hits[-1] - hits[0], (n - 1) / rate * 0.9)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(20)
+        waits = [bucket.reserve() for i in range(5)]
+        self.assertEqual(waits[0], 0.0)
+        for (i, w) in enumerate(waits[1:], 1):
+            self.assertAlmostEqual(w, i / 20, delta=0.01)
+
+
+class TestRunInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        eutils._client = None
+
+    def tearDown(self):
+        if eutils._client is not None:
+            eutils._client.close()
+            eutils._client = None
+        self.server.stop()
+
+    def test_query_project_metadata(self):
+        from scqc.sra import query_project_metadata
+        self.server.script('/runinfo', [(503, {}, b''), (200, {}, RUNINFO)])
+        config = make_config(max_rate=100, backoff=0.01,
+                             sra_runinfo=f'{self.server.url}/runinfo')
+        df = query_project_metadata('SRP000001', config)
+        self.assertEqual(list(df.Run), ['SRR000001', 'SRR000002'])
+        self.assertEqual(len(self.server.hits('/runinfo')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()